@@ -0,0 +1,235 @@
+from botocore.awsrequest import AWSRequest
+from botocore.serialize import create_serializer
+from email.message import EmailMessage
+from email.policy import SMTPUTF8
+from jwcrypto import jwe, jwk
+from jwcrypto.common import json_encode
+from ocoen.docsender import DocSender, _TrackingTokenEncoder, _create_mime_message, _read_body
+from ocoen.docsenderreplay import LocalBucket, LocalSes
+
+import hashlib
+
+import argparse
+import boto3
+import os
+import sys
+import tempfile
+import timeit
+import tracemalloc
+import yaml
+
+token_key = jwk.JWK.generate(kty='oct', size=256, kid='01BX5ZZKBKACTAV9WEVGEMMVRZ')
+token_claims = {
+    'profile_key': 'profiles/month-end.yaml',
+    'profile': {
+        'from': 'reports@example.com',
+        'to': 'finance@example.com',
+        'subject_template': 'Month end report {{ event.period }}',
+        'body_html_template': '<p>Please find attached the month end report for {{ event.period }}.</p>' * 10,
+    },
+    'event': {
+        'profile_key': 'profiles/month-end.yaml',
+        'result_key': 'results/2017-10/month-end.csv',
+        'period': '2017-10',
+    },
+}
+
+
+def _report(name, number, seconds):
+    print('{:<40} {:>10.1f} us/op {:>12.0f} ops/s'.format(name, seconds / number * 1e6, number / seconds))
+
+
+def benchmark_tracking_token(number):
+    def jwcrypto_token():
+        return jwe.JWE(
+            protected={
+                'alg': 'dir',
+                'enc': 'A256GCM',
+                'kid': token_key.key_id,
+                'zip': 'DEF',
+            },
+            plaintext=json_encode(token_claims),
+            recipient=token_key
+        ).serialize(compact=True)
+
+    encoder = _TrackingTokenEncoder()
+
+    def fast_token():
+        return encoder.encode(token_key, token_claims)
+
+    jwcrypto_seconds = timeit.timeit(jwcrypto_token, number=number)
+    fast_seconds = timeit.timeit(fast_token, number=number)
+    _report('tracking_token jwcrypto JWE', number, jwcrypto_seconds)
+    _report('tracking_token direct AES-GCM', number, fast_seconds)
+    print('tracking_token speedup: {:.1f}x'.format(jwcrypto_seconds / fast_seconds))
+
+
+render_profile = {
+    'from': 'reports@example.com',
+    'to': 'finance@example.com',
+    'subject_template': 'Month end report {{ event.period }}',
+    'body_html_template': '''
+<table>
+  <tr>{% for column in event.columns %}<th>{{ column | title }}</th>{% endfor %}</tr>
+  {% for row in event.rows %}
+  <tr class="{{ loop.cycle('odd', 'even') }}">
+    {% for column in event.columns %}<td>{{ row[column] }}</td>{% endfor %}
+  </tr>
+  {% endfor %}
+</table>
+<p>Total: {{ event.rows | sum(attribute='amount') }}</p>
+''',
+    'body_text_template': 'Month end report {{ event.period }}, {{ event.rows | length }} rows.',
+}
+render_event = {
+    'period': '2017-10',
+    'columns': ['account', 'description', 'amount', 'currency'],
+    'rows': [
+        {'account': str(i), 'description': 'Line item {}'.format(i), 'amount': i * 10, 'currency': 'NZD'}
+        for i in range(200)
+    ],
+}
+
+
+def benchmark_render(number):
+    profile_data = yaml.dump({'email': render_profile}).encode('utf-8')
+    untrusted = DocSender(None, None, None)
+    trusted = DocSender(None, None, None, trusted_profile_hashes=[hashlib.sha256(profile_data).hexdigest()])
+    untrusted_profile = untrusted._parse_profile(profile_data)
+    trusted_profile = trusted._parse_profile(profile_data)
+
+    sandboxed_seconds = timeit.timeit(
+        lambda: untrusted._format_message_parts(untrusted_profile, render_event), number=number)
+    trusted_seconds = timeit.timeit(
+        lambda: trusted._format_message_parts(trusted_profile, render_event), number=number)
+    _report('render sandboxed', number, sandboxed_seconds)
+    _report('render trusted precompiled', number, trusted_seconds)
+    print('render speedup: {:.1f}x'.format(sandboxed_seconds / trusted_seconds))
+
+
+def benchmark_recipients(number):
+    recipients = [{'to': 'user{}@example.com'.format(i), 'name': 'User {}'.format(i)} for i in range(50)]
+    profiles = LocalBucket()
+    profiles.put_object(Key='profile.yaml', Body=yaml.dump({'email': dict(
+        render_profile, subject_template='Month end report {{ event.period }} for {{ recipient.name }}',
+        attachment_name_template='month-end.csv',
+    )}).encode('utf-8'))
+    results = LocalBucket()
+    results.put_object(Key='result.csv', Body=b'account,description,amount\n' + b'1,Line item,10\n' * 20000)
+    docsender = DocSender(LocalSes(), profiles, results, lambda: token_key)
+    event = dict(render_event, recipients=recipients)
+
+    def per_recipient_events():
+        for recipient in recipients:
+            docsender.send_email('profile.yaml', 'result.csv', dict(render_event, recipients=[recipient]))
+
+    def recipient_list():
+        docsender.send_email('profile.yaml', 'result.csv', event)
+
+    per_event_seconds = timeit.timeit(per_recipient_events, number=number)
+    batched_seconds = timeit.timeit(recipient_list, number=number)
+    _report('recipients one event each (x50)', number, per_event_seconds)
+    _report('recipients batched (x50)', number, batched_seconds)
+    print('recipients speedup: {:.1f}x'.format(per_event_seconds / batched_seconds))
+
+
+def _email_package_mime_message(attachment_data):
+    email = EmailMessage(policy=SMTPUTF8)
+    email.set_content('Please find attached the month end report.')
+    email.make_mixed()
+    email['From'] = 'reports@example.com'
+    email['To'] = 'finance@example.com'
+    email['Subject'] = 'Month end report'
+    attachment_part = EmailMessage(policy=SMTPUTF8)
+    attachment_part.set_content(attachment_data, filename='month-end.pdf', maintype='application', subtype='pdf')
+    email.attach(attachment_part)
+    return email.as_bytes()
+
+
+def _docsender_mime_message(attachment_data):
+    return _create_mime_message(
+        from_='reports@example.com',
+        to='finance@example.com',
+        subject='Month end report',
+        message_formats={'text': 'Please find attached the month end report.'},
+        attachment={'name': 'month-end.pdf', 'data': attachment_data, 'type': ['application', 'pdf']},
+    )
+
+
+def _serialize_ses_request(operation_model, email):
+    return create_serializer('query').serialize_to_request({'RawMessage': {'Data': email}}, operation_model)
+
+
+def _prepare_ses_request(request):
+    return AWSRequest(method='POST', url='https://email.us-east-1.amazonaws.com/', data=request['body']).prepare()
+
+
+def _traced(func, *args):
+    # Restarting tracemalloc per step counts only what the step allocates, not the buffers it was given.
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, retained, peak
+
+
+def benchmark_copies(number):
+    attachment_size = 8 * 2 ** 20
+    attachment_data = os.urandom(attachment_size)
+    pipelines = [
+        ('email package', lambda body: body.read(), _email_package_mime_message),
+        ('docsender buffers', lambda body: _read_body(body, attachment_size), _docsender_mime_message),
+    ]
+    operation_model = boto3.session.Session(region_name='us-east-1').client('ses').meta.service_model.operation_model(
+        'SendRawEmail')
+    print('Full size copies of a {} MB attachment, peak (retained):'.format(attachment_size // 2 ** 20))
+    for name, read, create_mime_message in pipelines:
+        steps = []
+        # A file stands in for the connection, BytesIO.read() would return the buffer it was given without a copy.
+        with tempfile.TemporaryFile() as body:
+            body.write(attachment_data)
+            body.seek(0)
+            data, retained, peak = _traced(read, body)
+        steps.append(('load_attachment', retained, peak))
+        email, retained, peak = _traced(create_mime_message, data)
+        steps.append(('create_mime_message', retained, peak))
+        # The query protocol request is built by botocore, base64 encoding the message and then form encoding it.
+        request, retained, peak = _traced(_serialize_ses_request, operation_model, email)
+        steps.append(('botocore serialize', retained, peak))
+        _, retained, peak = _traced(_prepare_ses_request, request)
+        steps.append(('botocore urlencode', retained, peak))
+        print(name)
+        for step, retained, peak in steps:
+            print('  {:<24} {:>6.2f} peak {:>6.2f} retained'.format(
+                step, peak / attachment_size, retained / attachment_size))
+
+    for name, _, create_mime_message in pipelines:
+        _report('create_mime_message ' + name, number,
+                timeit.timeit(lambda: create_mime_message(attachment_data), number=number))
+
+
+BENCHMARKS = {
+    'copies': benchmark_copies,
+    'recipients': benchmark_recipients,
+    'render': benchmark_render,
+    'tracking_token': benchmark_tracking_token,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro benchmarks for the docsender pipeline.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='Benchmarks to run, from: {}. Runs all by default.'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('-n', '--number', type=int, default=2000, help='Iterations per benchmark.')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: ' + ', '.join(sorted(unknown)))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args.number)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
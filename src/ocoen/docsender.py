@@ -1,51 +1,314 @@
+from botocore.exceptions import ClientError
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from email.message import EmailMessage
 from email.policy import SMTPUTF8
+from fnmatch import fnmatchcase
+from functools import partial
 from html2text import html2text
-from jinja2 import select_autoescape, DictLoader, StrictUndefined
+from io import BytesIO, StringIO
+from jinja2 import nodes, select_autoescape, ChoiceLoader, DictLoader, Environment, StrictUndefined
+from jinja2.exceptions import TemplateError
 from jinja2.sandbox import ImmutableSandboxedEnvironment
-from jwcrypto import jwe
-from jwcrypto.common import json_encode
+from jwcrypto.common import base64url_decode, base64url_encode, json_decode, json_encode
+from ocoen.docsenderadmission import NO_MEMORY_BUDGET, estimate_send_bytes
+from ocoen.docsenderbreakers import NO_CIRCUIT_BREAKER
+from ocoen.docsenderfragments import FragmentLoader
+from ocoen.docsenderprofiling import NO_PROFILER
+from ocoen.docsendertracing import NOOP_TRACER
 
+import base64
+import binascii
+import csv
+import hashlib
+import json
 import logging
+import os
+import threading
 import time
 import yaml
+import zipfile
+import zlib
 
 
 logger = logging.getLogger(__name__)
 
+RenderLimits = namedtuple('RenderLimits', ['max_seconds', 'max_output_size', 'max_loop_iterations'])
+DEFAULT_RENDER_LIMITS = RenderLimits(max_seconds=10, max_output_size=10 * 2 ** 20, max_loop_iterations=10 ** 6)
+
+
+class TemplateLimitError(TemplateError):
+
+    def __init__(self, limit, message):
+        super().__init__(message)
+        self.limit = limit
+
+
+class _RenderLimitsMixin:
+
+    LOOP_GUARD = '_docsender_loop_guard'
+
+    def __init__(self, render_limits, **kwargs):
+        super().__init__(**kwargs)
+        self.render_limits = render_limits
+        self.globals[_RenderLimitsMixin.LOOP_GUARD] = self._guard_loop
+        self._budget = threading.local()
+
+    def _parse(self, source, name, filename):
+        template = super()._parse(source, name, filename)
+        for loop in template.find_all(nodes.For):
+            loop.iter = _guarded_loop_iterable(loop.iter)
+            if loop.recursive:
+                # Recursive loops iterate whatever is passed to loop(...) in their body, not loop.iter.
+                for call in _recursive_loop_calls(loop.body):
+                    call.args = [_guarded_loop_iterable(call.args[0])] + call.args[1:]
+        return template
+
+    @contextmanager
+    def render_budget(self):
+        self._budget.deadline = time.monotonic() + self.render_limits.max_seconds
+        self._budget.loop_iterations = 0
+        try:
+            yield
+        finally:
+            self._budget.deadline = None
+
+    def _check_deadline(self):
+        deadline = getattr(self._budget, 'deadline', None)
+        if deadline is not None and time.monotonic() > deadline:
+            raise TemplateLimitError('max_seconds', 'Template rendering took longer than {} seconds'.format(
+                self.render_limits.max_seconds))
+
+    def _guard_loop(self, iterable):
+        for item in iterable:
+            self._budget.loop_iterations += 1
+            if self._budget.loop_iterations > self.render_limits.max_loop_iterations:
+                raise TemplateLimitError('max_loop_iterations', 'Template loops ran more than {} iterations'.format(
+                    self.render_limits.max_loop_iterations))
+            self._check_deadline()
+            yield item
+
+    def render(self, template, **context):
+        output = []
+        output_size = 0
+        for chunk in template.generate(**context):
+            output_size += len(chunk)
+            if output_size > self.render_limits.max_output_size:
+                raise TemplateLimitError('max_output_size', 'Template output is larger than {} characters'.format(
+                    self.render_limits.max_output_size))
+            self._check_deadline()
+            output.append(chunk)
+        return ''.join(output)
+
+
+def _guarded_loop_iterable(iterable):
+    return nodes.Call(
+        nodes.Name(_RenderLimitsMixin.LOOP_GUARD, 'load', lineno=iterable.lineno),
+        [iterable], [], None, None,
+        lineno=iterable.lineno,
+    )
+
+
+def _recursive_loop_calls(body):
+    calls = []
+    for child in body:
+        if isinstance(child, nodes.For):
+            # loop refers to the nested loop inside it, that loop's own calls are guarded when it is visited.
+            continue
+        if isinstance(child, nodes.Call) and isinstance(child.node, nodes.Name) and child.node.name == 'loop' \
+                and child.args:
+            calls.append(child)
+        calls.extend(_recursive_loop_calls(child.iter_child_nodes()))
+    return calls
+
+
+class _LimitedEnvironment(_RenderLimitsMixin, Environment):
+    pass
+
+
+class _LimitedSandboxedEnvironment(_RenderLimitsMixin, ImmutableSandboxedEnvironment):
+
+    intercepted_binops = frozenset(['*'])
+
+    def call_binop(self, context, operator, left, right):
+        if operator == '*':
+            for sequence, count in ((left, right), (right, left)):
+                if isinstance(sequence, (str, list, tuple)) and isinstance(count, int) \
+                        and len(sequence) * count > self.render_limits.max_output_size:
+                    raise TemplateLimitError('max_output_size', 'Template output is larger than {} characters'.format(
+                        self.render_limits.max_output_size))
+        return super().call_binop(context, operator, left, right)
+
+    def call(__self, __context, __obj, *args, **kwargs):
+        __self._check_deadline()
+        return super().call(__context, __obj, *args, **kwargs)
+
+
+class _TrustedProfile(dict):
+    digest = None
+
+
+def _environment_options(templates, fragment_loader=None):
+    if fragment_loader is None:
+        loader = DictLoader(templates)
+    else:
+        loader = ChoiceLoader([DictLoader(templates), fragment_loader])
+    return {
+        'autoescape': select_autoescape(['html']),
+        # Included fragments are checked against the fragment store when templates are fetched from the cache.
+        'auto_reload': fragment_loader is not None,
+        'loader': loader,
+        'undefined': StrictUndefined,
+    }
+
 
 class DocSender:
 
     MESSAGE_PARTS = ['attachment_name', 'subject']
     BODY_TYPES = ['html', 'text']
+    STAGES = [
+        'load_profile',
+        'load_attachment',
+        'create_tracking_token',
+        'format_message',
+        'create_mime_message',
+        'send_raw_email',
+    ]
+    ATTACHMENT_CHUNK_SIZE = 2 ** 20
+    TRUSTED_ENVIRONMENT_CACHE_SIZE = 64
+    WARM_UP_MAX_WORKERS = 16
 
-    def __init__(self, ses_client, profile_bucket, attachment_bucket, token_key_provider=None):
+    def __init__(self, ses_client, profile_bucket, attachment_bucket, token_key_provider=None,
+                 render_limits=DEFAULT_RENDER_LIMITS, profiler=NO_PROFILER, tracer=NOOP_TRACER,
+                 trusted_profile_hashes=(), memory_budget=NO_MEMORY_BUDGET, fragments=None,
+                 circuit_breakers=None, concurrency_limit=None):
         self._ses = ses_client
         self._profile_bucket = profile_bucket
         self._attachment_bucket = attachment_bucket
         self._token_key_provider = token_key_provider
+        self._render_limits = render_limits
+        self._profiler = profiler
+        self._tracer = tracer
+        self._trusted_profile_hashes = frozenset(digest.lower() for digest in trusted_profile_hashes)
+        self._trusted_environments = OrderedDict()
+        self._trusted_environmentsLock = threading.Lock()
+        self._memory_budget = memory_budget
+        self._reservations = threading.local()
+        self._warm_profiles = {}
+        self._fragment_loader = None if fragments is None else FragmentLoader(fragments, self._trusted_profile_hashes)
+        self._circuit_breakers = circuit_breakers or {}
+        self._concurrency_limit = concurrency_limit
+        if concurrency_limit is not None:
+            # Calls through the breakers grow the limit, slow or failed calls and rejections shrink it.
+            for circuit_breaker in self._circuit_breakers.values():
+                circuit_breaker.add_listener(concurrency_limit)
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @contextmanager
+    def _stage(self, metrics, stage):
+        with self._tracer.span(stage), _timed(metrics, stage):
+            yield
+
+    def _guard(self, service):
+        return self._circuit_breakers.get(service, NO_CIRCUIT_BREAKER).guard()
+
+    @contextmanager
+    def _admission(self):
+        # Memory reserved while loading the attachment is held until the message is built, or sent for send_email.
+        reservations = []
+        self._reservations.current = reservations
+        try:
+            yield
+        finally:
+            self._reservations.current = None
+            for nbytes in reservations:
+                self._memory_budget.release(nbytes)
+
+    def _admit(self, attachment_response):
+        reservations = getattr(self._reservations, 'current', None)
+        if reservations is None:
+            return
+        nbytes = estimate_send_bytes(attachment_response.get('ContentLength'))
+        self._memory_budget.acquire(nbytes)
+        reservations.append(nbytes)
 
     def _load_profile(self, profile_key):
         profile_object = self._profile_bucket.Object(profile_key)
-        profile_body = profile_object.get()['Body']
-        return yaml.load(profile_body.read())['email']
+        warm_profile = self._warm_profiles.get(profile_key)
+        if warm_profile is None:
+            with self._guard('s3'):
+                profile_data = profile_object.get()['Body'].read()
+            return self._parse_profile(profile_data)
+
+        etag, profile = warm_profile
+        try:
+            with self._guard('s3'):
+                profile_response = profile_object.get(IfNoneMatch=etag)
+                profile_data = profile_response['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == '304':
+                return profile
+            raise
+        profile = self._parse_profile(profile_data)
+        self._warm_profiles[profile_key] = (profile_response['ETag'], profile)
+        return profile
+
+    def warm_up(self, profile_keys, max_workers=WARM_UP_MAX_WORKERS):
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers) as executor:
+            results = executor.map(self._warm_up_profile, profile_keys)
+            if self._token_key_provider is not None:
+                executor.submit(self._warm_up_token_key)
+            warmed = sum(results)
+        logger.info('Warmed up %d profiles in %.3fs.', warmed, time.time() - start_time)
+        return warmed
+
+    def _warm_up_profile(self, profile_key):
+        try:
+            with self._guard('s3'):
+                profile_response = self._profile_bucket.Object(profile_key).get()
+            profile = self._parse_profile(profile_response['Body'].read())
+            templates, _ = self._build_templates_dict(profile)
+            environment = self._environment(profile, templates)
+            for template_name in templates:
+                environment.get_template(template_name)
+        except Exception:
+            logger.exception('Failed to warm up profile %s.', profile_key)
+            return False
+        # Warmed profiles are revalidated with a conditional GET, unchanged profiles are neither downloaded nor parsed.
+        if profile_response.get('ETag') is not None:
+            self._warm_profiles[profile_key] = (profile_response['ETag'], profile)
+        return True
+
+    def _warm_up_token_key(self):
+        try:
+            _encode_tracking_token(self._token_key_provider(), {})
+        except Exception:
+            logger.exception('Failed to pre-generate the tracking token key.')
+
+    def _parse_profile(self, profile_data):
+        profile = _parse_profile(profile_data)
+        if self._trusted_profile_hashes:
+            if isinstance(profile_data, str):
+                profile_data = profile_data.encode('utf-8')
+            digest = hashlib.sha256(profile_data).hexdigest()
+            if digest in self._trusted_profile_hashes:
+                profile = _TrustedProfile(profile)
+                profile.digest = digest
+        return profile
 
     def _create_tracking_token(self, **kwargs):
         if self._token_key_provider is None:
             return None
-        token_key = self._token_key_provider()
-        token = jwe.JWE(
-            protected={
-                'alg': 'dir',
-                'enc': 'A256GCM',
-                'kid': token_key.key_id,
-                'zip': 'DEF',
-            },
-            plaintext=json_encode(kwargs),
-            recipient=token_key
-        )
-        return token.serialize(compact=True)
+        with self._guard('kms'):
+            token_key = self._token_key_provider()
+        return _encode_tracking_token(token_key, kwargs)
 
     def _build_templates_dict(self, profile):
         templates = {}
@@ -63,87 +326,559 @@ class DocSender:
                 templates[template_name] = profile[template_key]
         return templates, template_names
 
+    def _environment(self, profile, templates):
+        if not isinstance(profile, _TrustedProfile):
+            return _LimitedSandboxedEnvironment(self._render_limits,
+                                                **_environment_options(templates, self._fragment_loader))
+
+        with self._trusted_environmentsLock:
+            environment = self._trusted_environments.get(profile.digest)
+            if environment is not None:
+                self._trusted_environments.move_to_end(profile.digest)
+                return environment
+        environment = _LimitedEnvironment(self._render_limits,
+                                          **_environment_options(templates, self._fragment_loader))
+        for template_name in templates:
+            environment.get_template(template_name)
+        with self._trusted_environmentsLock:
+            self._trusted_environments[profile.digest] = environment
+            while len(self._trusted_environments) > DocSender.TRUSTED_ENVIRONMENT_CACHE_SIZE:
+                self._trusted_environments.popitem(last=False)
+        return environment
+
     def _format_message_parts(self, profile, event_in):
-        event = deepcopy(event_in)
+        return self._message_parts_renderer(profile)(event=deepcopy(event_in))
+
+    def _message_parts_renderer(self, profile):
         templates, template_names = self._build_templates_dict(profile)
-        envionment = ImmutableSandboxedEnvironment(
-            autoescape=select_autoescape(['html']),
-            auto_reload=False,
-            loader=DictLoader(templates),
-            undefined=StrictUndefined,
+        envionment = self._environment(profile, templates)
+        return partial(_render_message_parts, envionment, templates, template_names)
+
+    def _load_attachment(self, attachment_key):
+        attachment_object = self._attachment_bucket.Object(attachment_key)
+        with self._guard('s3'):
+            attachment_response = attachment_object.get()
+        # Waiting for the memory budget is not S3 latency, the body is read under a guard of its own.
+        self._admit(attachment_response)
+        attachment_body = attachment_response['Body']
+        with self._guard('s3'):
+            attachment_data = _read_body(attachment_body, attachment_response.get('ContentLength'))
+        return attachment_data, attachment_response['ContentType'].split('/')
+
+    def _load_compressed_attachment(self, attachment_key, compression, metrics):
+        attachment_object = self._attachment_bucket.Object(attachment_key)
+        with self._guard('s3'):
+            attachment_response = attachment_object.get()
+        self._admit(attachment_response)
+        attachment_body = attachment_response['Body']
+        content_type = attachment_response['ContentType']
+        content_length = attachment_response.get('ContentLength')
+        if not _should_compress_attachment(compression, content_type, content_length):
+            with self._guard('s3'):
+                attachment_data = _read_body(attachment_body, content_length)
+            return attachment_data, content_type.split('/'), ''
+
+        chunks = iter(partial(self._read_chunk, attachment_body), b'')
+        return _compress_attachment(chunks, attachment_key, compression, metrics)
+
+    def _read_chunk(self, body):
+        # Each chunk is its own call, compressing between reads is not S3 latency.
+        with self._guard('s3'):
+            return body.read(DocSender.ATTACHMENT_CHUNK_SIZE)
+
+    @contextmanager
+    def _format_message_stage(self, metrics):
+        with self._stage(metrics, 'format_message'):
+            try:
+                yield
+            except TemplateLimitError as e:
+                metrics['render_limit_exceeded'] = e.limit
+                logger.warning('Template render limit %s exceeded: %s', e.limit, e)
+                raise
+
+    def _load_profile_attachment(self, profile, attachment_key, metrics):
+        if 'attachment_compression' in profile:
+            return self._load_compressed_attachment(attachment_key, profile['attachment_compression'], metrics)
+        attachment_data, attachment_type = self._load_attachment(attachment_key)
+        return attachment_data, attachment_type, ''
+
+    def _load_recipients(self, event):
+        if 'recipients' in event:
+            recipients = event['recipients']
+        else:
+            with self._guard('s3'):
+                recipients_response = self._attachment_bucket.Object(event['recipients_key']).get()
+                recipients_data = recipients_response['Body'].read()
+            recipients = _parse_recipients(recipients_data, event['recipients_key'],
+                                           recipients_response.get('ContentType', ''))
+        for recipient in recipients:
+            if not recipient.get('to'):
+                raise ValueError('Every recipient must have a to address but was ' + str(recipient))
+        return recipients
+
+    def _render_email(self, profile, event, attachment_data, attachment_type, tracking_token, metrics,
+                      attachment_suffix=''):
+        with self._format_message_stage(metrics):
+            message_parts = self._format_message_parts(profile, event)
+        attachment_name = message_parts['attachment_name']
+        if attachment_name is not None:
+            attachment_name += attachment_suffix
+        with self._stage(metrics, 'create_mime_message'):
+            return _create_mime_message(
+                from_=profile['from'],
+                to=profile['to'],
+                subject=message_parts['subject'],
+                message_formats=message_parts['body'],
+                tracking_token=tracking_token,
+                attachment={
+                    'name': attachment_name,
+                    'data': attachment_data,
+                    'type': attachment_type,
+                },
+            )
+
+    def build_email(self, profile_key, attachment_key, event):
+        if _has_recipients(event):
+            raise ValueError('Recipient lists are only supported by send_email')
+        with self._profiler.profile(profile_key), self._admission(), \
+                self._tracer.span('build_email', attributes=_span_attributes(profile_key, attachment_key)) as span:
+            metrics = {}
+            try:
+                email, metrics = self._build_email(profile_key, attachment_key, event, metrics)
+            finally:
+                _set_metric_attributes(span, metrics)
+            return email, metrics
+
+    def _build_email(self, profile_key, attachment_key, event, metrics=None):
+        if metrics is None:
+            metrics = {}
+        with self._stage(metrics, 'load_profile'):
+            profile = self._load_profile(profile_key)
+        with self._stage(metrics, 'load_attachment'):
+            attachment_data, attachment_type, attachment_suffix = self._load_profile_attachment(
+                profile, attachment_key, metrics
+            )
+        with self._stage(metrics, 'create_tracking_token'):
+            tracking_token = self._create_tracking_token(
+                profile_key=profile_key,
+                profile=profile,
+                event=event
+            )
+        email = self._render_email(profile, event, attachment_data, attachment_type, tracking_token, metrics,
+                                   attachment_suffix)
+        metrics['email_size'] = len(email)
+        metrics['attachment_size'] = len(attachment_data)
+        return email, metrics
+
+    def send_raw_email(self, email, metrics=None):
+        if metrics is None:
+            metrics = {}
+        with self._stage(metrics, 'send_raw_email'), self._guard('ses'):
+            self._ses.send_raw_email(
+                RawMessage={'Data': email},
+            )
+        return metrics
+
+    def send_email(self, profile_key, attachment_key, event):
+        with self._profiler.profile(profile_key), self._admission(), \
+                self._tracer.span('send_email', attributes=_span_attributes(profile_key, attachment_key)) as span:
+            metrics = {}
+            # Metrics of failed sends, such as render_limit_exceeded, are still recorded on the span and logged.
+            try:
+                if _has_recipients(event):
+                    self._send_to_recipients(profile_key, attachment_key, event, metrics)
+                else:
+                    email, metrics = self._build_email(profile_key, attachment_key, event, metrics)
+                    self.send_raw_email(email, metrics)
+            finally:
+                _set_metric_attributes(span, metrics)
+                _log_metrics(metrics)
+        return metrics
+
+    def _send_to_recipients(self, profile_key, attachment_key, event, metrics):
+        with self._stage(metrics, 'load_profile'):
+            profile = self._load_profile(profile_key)
+        with self._stage(metrics, 'load_recipients'):
+            recipients = self._load_recipients(event)
+        with self._stage(metrics, 'load_attachment'):
+            attachment_data, attachment_type, attachment_suffix = self._load_profile_attachment(
+                profile, attachment_key, metrics
+            )
+        # Templates are compiled and the attachment encoded once, only rendering and assembly run per recipient.
+        send = partial(
+            self._send_to_recipient,
+            profile_key,
+            profile,
+            {key: value for key, value in event.items() if key != 'recipients'},
+            self._message_parts_renderer(profile),
+            (_encode_base64(attachment_data), attachment_type, attachment_suffix),
+            {},
         )
+        if self._concurrency_limit is None:
+            results = [send(recipient) for recipient in recipients]
+        else:
+            results = self._send_concurrently(send, recipients)
+        metrics['recipients'] = len(recipients)
+        metrics['recipients_failed'] = 0
+        metrics['email_size'] = 0
+        error = None
+        for recipient_metrics, recipient_error in results:
+            if recipient_error is None:
+                metrics['email_size'] += recipient_metrics['email_size']
+            else:
+                metrics['recipients_failed'] += 1
+                error = recipient_error
+            for stage, value in recipient_metrics.items():
+                if stage in DocSender.STAGES:
+                    metrics[stage] = metrics.get(stage, 0) + value
+                elif stage != 'email_size':
+                    metrics[stage] = value
+        metrics['attachment_size'] = len(attachment_data)
+        # Partial failures are not raised, a retry of the event would send duplicates to the delivered recipients.
+        if error is not None and metrics['recipients_failed'] == len(recipients):
+            raise error
+        return metrics
+
+    def _send_to_recipient(self, profile_key, profile, shared_event, render_message_parts, attachment,
+                           attachment_parts, recipient):
+        encoded_attachment, attachment_type, attachment_suffix = attachment
+        recipient_metrics = {}
+        try:
+            with self._stage(recipient_metrics, 'create_tracking_token'):
+                tracking_token = self._create_tracking_token(
+                    profile_key=profile_key,
+                    profile=profile,
+                    event=shared_event,
+                    recipient=recipient,
+                )
+            with self._format_message_stage(recipient_metrics):
+                message_parts = render_message_parts(event=deepcopy(shared_event), recipient=deepcopy(recipient))
+            attachment_name = message_parts['attachment_name']
+            if attachment_name is not None:
+                attachment_name += attachment_suffix
+            with self._stage(recipient_metrics, 'create_mime_message'):
+                if attachment_name not in attachment_parts:
+                    attachment_parts[attachment_name] = _create_attachment_part({
+                        'name': attachment_name,
+                        'type': attachment_type,
+                    })
+                attachment_part = attachment_parts[attachment_name]
+                email = _write_mime_message(_assemble_mime_message(
+                    from_=profile['from'],
+                    to=recipient['to'],
+                    subject=message_parts['subject'],
+                    message_formats=message_parts['body'],
+                    tracking_token=tracking_token,
+                    attachment_part=attachment_part.placeholder,
+                ), attachment_part.token_line, encoded_attachment, encoded=True)
+            self.send_raw_email(email, recipient_metrics)
+            recipient_metrics['email_size'] = len(email)
+        except Exception as e:
+            logger.exception('Failed to send %s to recipient %s.', profile_key, recipient['to'])
+            return recipient_metrics, e
+        return recipient_metrics, None
+
+    def _send_concurrently(self, send, recipients):
+        concurrency_limit = self._concurrency_limit
+        parent_span = self._tracer.current_span()
+
+        def send_in_slot(recipient):
+            try:
+                with self._tracer.activate(parent_span):
+                    return send(recipient)
+            finally:
+                concurrency_limit.release()
 
-        message_parts = {}
+        futures = []
+        with ThreadPoolExecutor(concurrency_limit.max_limit) as executor:
+            for recipient in recipients:
+                # Waiting for a slot here keeps a degraded SES from queueing the whole list behind slow sends.
+                concurrency_limit.acquire()
+                futures.append(executor.submit(send_in_slot, recipient))
+        return [future.result() for future in futures]
+
+
+def _render_message_parts(envionment, templates, template_names, **context):
+    message_parts = {}
+    body = {}
+    with envionment.render_budget():
         for part in DocSender.MESSAGE_PARTS:
             if part in template_names:
                 template_name = template_names[part]
                 template = envionment.get_template(template_name)
-                message_parts[part] = template.render(event=event, **message_parts)
+                message_parts[part] = envionment.render(template, **dict(context, **message_parts))
             else:
                 message_parts[part] = None
-        body = {}
         for type_ in DocSender.BODY_TYPES:
             template_name = 'body.{}'.format(type_)
             if template_name in templates:
                 template = envionment.get_template(template_name)
-                body[type_] = template.render(event=event, **message_parts)
-        if 'html' in body and 'text' not in body:
-            body['text'] = html2text(body['html'])
+                body[type_] = envionment.render(template, **dict(context, **message_parts))
+    if 'html' in body and 'text' not in body:
+        body['text'] = html2text(body['html'])
 
-        message_parts['body'] = body
-        return message_parts
+    message_parts['body'] = body
+    return message_parts
 
-    def _load_attachment(self, attachment_key):
-        attachment_object = self._attachment_bucket.Object(attachment_key)
-        attachment_response = attachment_object.get()
-        attachment_body = attachment_response['Body']
-        return attachment_body.read(), attachment_response['ContentType'].split('/')
 
-    def send_email(self, profile_key, attachment_key, event):
-        time_start = time.time()
-        profile = self._load_profile(profile_key)
-        time_load_profile = time.time()
-        attachment_data, attachment_type = self._load_attachment(attachment_key)
-        time_load_attachment = time.time()
-        tracking_token = self._create_tracking_token(
-            profile_key=profile_key,
-            profile=profile,
-            event=event
-        )
-        time_create_tracking_token = time.time()
-        message_parts = self._format_message_parts(profile, event)
-        time_format_message = time.time()
-        email = _create_mime_message(
-            from_=profile['from'],
-            to=profile['to'],
-            subject=message_parts['subject'],
-            message_formats=message_parts['body'],
-            tracking_token=tracking_token,
-            attachment={
-                'name': message_parts['attachment_name'],
-                'data': attachment_data,
-                'type': attachment_type,
-            },
-        )
-        time_create_mime_message = time.time()
-        self._ses.send_raw_email(
-            RawMessage={'Data': email},
-        )
-        time_send_email = time.time()
-        logger.debug('\n'.join([
-            'send_email timings:',
-            'load_profile: ' + str(time_load_profile - time_start),
-            'load_attachment: ' + str(time_load_attachment - time_load_profile),
-            'create_tracking_token: ' + str(time_create_tracking_token - time_load_attachment),
-            'format_message: ' + str(time_format_message - time_create_tracking_token),
-            'create_mime_message: ' + str(time_create_mime_message - time_format_message),
-            'send_raw_email: ' + str(time_send_email - time_create_mime_message),
-            'email size: ' + str(len(email)),
-            'attachment size: ' + str(len(attachment_data)),
-        ]))
+def _has_recipients(event):
+    return 'recipients' in event or 'recipients_key' in event
+
+
+def _parse_recipients(recipients_data, recipients_key, content_type):
+    if recipients_key.endswith('.csv') or content_type.startswith('text/csv'):
+        return list(csv.DictReader(StringIO(recipients_data.decode('utf-8-sig'))))
+    return json.loads(recipients_data.decode('utf-8'))
+
+
+def _parse_profile(profile_data):
+    return yaml.load(profile_data)['email']
+
+
+class _TrackingTokenEncoder:
+
+    IV_SIZE = 96 // 8
+    TAG_SIZE = 128 // 8
+
+    def __init__(self, max_keys=8):
+        self._max_keys = max_keys
+        self._ciphers = OrderedDict()
+        self._ciphersLock = threading.Lock()
+
+    def _cipher(self, token_key):
+        key_id = token_key.key_id
+        with self._ciphersLock:
+            cached = self._ciphers.get(key_id)
+            if cached is not None and cached[0] is token_key:
+                self._ciphers.move_to_end(key_id)
+                return cached[1]
+        protected = base64url_encode(json_encode({
+            'alg': 'dir',
+            'enc': 'A256GCM',
+            'kid': key_id,
+            'zip': 'DEF',
+        }))
+        cipher = AESGCM(base64url_decode(json_decode(token_key.export())['k'])), protected
+        with self._ciphersLock:
+            self._ciphers[key_id] = token_key, cipher
+            while len(self._ciphers) > self._max_keys:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+    def encode(self, token_key, claims):
+        cipher, protected = self._cipher(token_key)
+        iv = os.urandom(_TrackingTokenEncoder.IV_SIZE)
+        # Raw DEFLATE, as used by the JWE "zip": "DEF" header.
+        plaintext = zlib.compress(json_encode(claims).encode('utf-8'))[2:-4]
+        encrypted = cipher.encrypt(iv, plaintext, protected.encode('ascii'))
+        return '.'.join([
+            protected,
+            '',
+            base64url_encode(iv),
+            base64url_encode(encrypted[:-_TrackingTokenEncoder.TAG_SIZE]),
+            base64url_encode(encrypted[-_TrackingTokenEncoder.TAG_SIZE:]),
+        ])
+
+
+_tracking_token_encoder = _TrackingTokenEncoder()
+
+
+def _encode_tracking_token(token_key, claims):
+    return _tracking_token_encoder.encode(token_key, claims)
+
+
+class _GzipCompressor:
+
+    def __init__(self, filename, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(self._compressor.compress(data))
+
+    def finish(self):
+        self._chunks.append(self._compressor.flush())
+        return b''.join(self._chunks)
+
+
+class _ZipCompressor:
+
+    def __init__(self, filename, level):
+        self._buffer = BytesIO()
+        # compresslevel is only honoured by ZipFile from Python 3.7.
+        self._zip = zipfile.ZipFile(self._buffer, 'w', zipfile.ZIP_DEFLATED)
+        self._entry = self._zip.open(filename, 'w', force_zip64=True)
+
+    def write(self, data):
+        self._entry.write(data)
+
+    def finish(self):
+        self._entry.close()
+        self._zip.close()
+        return self._buffer.getvalue()
+
+
+_ATTACHMENT_COMPRESSION_FORMATS = {
+    'gzip': {
+        'compressor': _GzipCompressor,
+        'type': ['application', 'gzip'],
+        'suffix': '.gz',
+    },
+    'zip': {
+        'compressor': _ZipCompressor,
+        'type': ['application', 'zip'],
+        'suffix': '.zip',
+    },
+}
+_DEFAULT_COMPRESSED_CONTENT_TYPES = ['text/*', 'application/xml', 'application/json']
+
+
+def _should_compress_attachment(compression, content_type, content_length):
+    if content_length is not None and content_length < compression.get('min_size', 0):
+        return False
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    content_types = compression.get('content_types', _DEFAULT_COMPRESSED_CONTENT_TYPES)
+    return any(fnmatchcase(content_type, pattern) for pattern in content_types)
+
+
+def _compress_attachment(chunks, attachment_key, compression, metrics):
+    format_name = compression.get('format', 'gzip')
+    if format_name not in _ATTACHMENT_COMPRESSION_FORMATS:
+        raise ValueError('attachment_compression format must be one of {} but was {}'.format(
+            sorted(_ATTACHMENT_COMPRESSION_FORMATS), format_name))
+    compression_format = _ATTACHMENT_COMPRESSION_FORMATS[format_name]
+    compressor = compression_format['compressor'](
+        attachment_key.rsplit('/', 1)[-1],
+        compression.get('level', zlib.Z_DEFAULT_COMPRESSION),
+    )
+    uncompressed_size = 0
+    for chunk in chunks:
+        uncompressed_size += len(chunk)
+        compressor.write(chunk)
+    attachment_data = compressor.finish()
+
+    metrics['attachment_uncompressed_size'] = uncompressed_size
+    metrics['attachment_compression_ratio'] = uncompressed_size / max(len(attachment_data), 1)
+    return attachment_data, compression_format['type'], compression_format['suffix']
+
+
+def _read_body(body, content_length):
+    readinto = getattr(body, 'readinto', None)
+    if content_length is None or readinto is None:
+        return body.read()
+    # Reading into one buffer of the object's size avoids joining the chunks read from the connection into a copy.
+    data = bytearray(content_length)
+    with memoryview(data) as view:
+        offset = 0
+        while offset < content_length:
+            read = readinto(view[offset:])
+            if not read:
+                raise OSError('Expected {} bytes but the body ended after {}'.format(content_length, offset))
+            offset += read
+    return data
+
+
+def _span_attributes(profile_key, attachment_key):
+    return {
+        'profile_key': profile_key,
+        'attachment_key': attachment_key,
+    }
+
+
+def _set_metric_attributes(span, metrics):
+    for name, value in metrics.items():
+        if name not in DocSender.STAGES:
+            span.set_attribute(name, value)
+
+
+@contextmanager
+def _timed(metrics, stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics[stage] = time.time() - start
+
+
+def _log_metrics(metrics):
+    logger.debug('\n'.join(['send_email timings:'] + [
+        '{}: {}'.format(name, value) for name, value in metrics.items()
+    ]))
 
 
 def _create_mime_message(from_, to, subject, message_formats, attachment=None, tracking_token=None):
+    if attachment is None:
+        return _assemble_mime_message(from_, to, subject, message_formats, None, tracking_token)
+    attachment_part = _create_attachment_part(attachment)
+    return _write_mime_message(
+        _assemble_mime_message(from_, to, subject, message_formats, attachment_part.placeholder, tracking_token),
+        attachment_part.token_line,
+        attachment['data'],
+    )
+
+
+_AttachmentPart = namedtuple('_AttachmentPart', ['placeholder', 'token_line'])
+
+_MIME_LINESEP = SMTPUTF8.linesep.encode('ascii')
+# base64.encodebytes writes lines of the same 57 bytes the email package does for 78 character lines.
+_BASE64_BLOCK_SIZE = base64.MAXBINSIZE * 2 ** 10
+_PLACEHOLDER_TOKEN_SIZE = 48
+
+
+def _create_attachment_part(attachment):
+    # The email package serialises the part around a one line random token, the attachment is then base64 encoded
+    # straight into the output buffer in its place. Base64 bodies cannot contain the generated MIME boundaries.
+    token = os.urandom(_PLACEHOLDER_TOKEN_SIZE)
+    placeholder = EmailMessage(policy=SMTPUTF8)
+    placeholder.set_content(token, filename=attachment['name'],
+                            maintype=attachment['type'][0], subtype=attachment['type'][1])
+    if 'content-disposition' not in placeholder:
+        placeholder['Content-Disposition'] = 'attachment'
+    return _AttachmentPart(placeholder, binascii.b2a_base64(token, newline=False) + _MIME_LINESEP)
+
+
+def _base64_size(size):
+    lines, remainder = divmod(size, base64.MAXBINSIZE)
+    encoded_size = lines * (base64.MAXLINESIZE + len(_MIME_LINESEP))
+    if remainder:
+        encoded_size += (remainder + 2) // 3 * 4 + len(_MIME_LINESEP)
+    return encoded_size
+
+
+def _write_base64(output, data):
+    offset = 0
+    with memoryview(data) as data_view:
+        for start in range(0, len(data_view), _BASE64_BLOCK_SIZE):
+            encoded = base64.encodebytes(data_view[start:start + _BASE64_BLOCK_SIZE])
+            if _MIME_LINESEP != b'\n':
+                encoded = encoded.replace(b'\n', _MIME_LINESEP)
+            output[offset:offset + len(encoded)] = encoded
+            offset += len(encoded)
+
+
+def _encode_base64(data):
+    encoded = bytearray(_base64_size(len(data)))
+    with memoryview(encoded) as view:
+        _write_base64(view, data)
+    return encoded
+
+
+def _write_mime_message(message_data, token_line, attachment_data, encoded=False):
+    head, tail = message_data.split(token_line, 1)
+    body_size = len(attachment_data) if encoded else _base64_size(len(attachment_data))
+    body_end = len(head) + body_size
+    output = bytearray(body_end + len(tail))
+    with memoryview(output) as view:
+        view[:len(head)] = head
+        if encoded:
+            view[len(head):body_end] = attachment_data
+        else:
+            _write_base64(view[len(head):body_end], attachment_data)
+        view[body_end:] = tail
+    return output
+
+
+def _assemble_mime_message(from_, to, subject, message_formats, attachment_part=None, tracking_token=None):
     if message_formats is None:
         raise ValueError('Message_formats must be a dict but was ' + str(message_formats))
     email = _create_mime_body(message_formats)
@@ -154,9 +889,8 @@ def _create_mime_message(from_, to, subject, message_formats, attachment=None, t
     if tracking_token is not None:
         email['x-ocoen-tracking-token'] = tracking_token
 
-    if attachment is not None:
-        email.add_attachment(attachment['data'], filename=attachment['name'],
-                             maintype=attachment['type'][0], subtype=attachment['type'][1])
+    if attachment_part is not None:
+        email.attach(attachment_part)
 
     return email.as_bytes()
 
@@ -0,0 +1,212 @@
+from collections import deque
+from contextlib import contextmanager
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The raw attachment, its base64 MIME payload, the serialised message and the base64 SES request body can all be
+# alive at once, so a send peaks at several times the attachment size.
+SEND_MEMORY_MULTIPLIER = 6
+SEND_MEMORY_OVERHEAD = 2 ** 20
+
+_CGROUP_MEMORY_LIMITS = [
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+]
+
+
+def estimate_send_bytes(content_length):
+    return (content_length or 0) * SEND_MEMORY_MULTIPLIER + SEND_MEMORY_OVERHEAD
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _FifoAdmission:
+
+    def __init__(self):
+        self.in_flight = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _fits(self, amount):
+        raise NotImplementedError()
+
+    def _waiting(self, amount):
+        pass
+
+    def _try_acquire(self, amount):
+        if not self._waiters and self._fits(amount):
+            self.in_flight += amount
+            return True
+        return False
+
+    def _admit_waiters(self):
+        # Waiters are admitted in arrival order so a large request is not starved by a stream of small ones.
+        while self._waiters and self._fits(self._waiters[0][0]):
+            amount, admit = self._waiters.popleft()
+            self.in_flight += amount
+            admit()
+
+    def acquire(self, amount=1):
+        with self._lock:
+            if self._try_acquire(amount):
+                return
+            admitted = threading.Event()
+            self._waiters.append((amount, admitted.set))
+        self._waiting(amount)
+        admitted.wait()
+
+    async def acquire_async(self, amount=1):
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            if self._try_acquire(amount):
+                return
+            admitted = loop.create_future()
+            waiter = (amount, lambda: loop.call_soon_threadsafe(_set_result, admitted))
+            self._waiters.append(waiter)
+        self._waiting(amount)
+        try:
+            await admitted
+        except asyncio.CancelledError:
+            with self._lock:
+                admitted_before_cancel = waiter not in self._waiters
+                if not admitted_before_cancel:
+                    self._waiters.remove(waiter)
+            # Releasing also admits any waiters that were queued behind the cancelled one.
+            self.release(amount if admitted_before_cancel else 0)
+            raise
+
+    def release(self, amount=1):
+        with self._lock:
+            self.in_flight -= amount
+            self._admit_waiters()
+
+
+class MemoryBudget(_FifoAdmission):
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    @property
+    def in_flight_bytes(self):
+        return self.in_flight
+
+    def _fits(self, nbytes):
+        # A send larger than the whole budget is admitted once nothing else is in flight, serialising it.
+        return self.in_flight == 0 or self.in_flight + nbytes <= self.max_bytes
+
+    def _waiting(self, nbytes):
+        logger.info('Waiting for %d bytes of memory budget, %d of %d in flight.',
+                    nbytes, self.in_flight, self.max_bytes)
+
+    @contextmanager
+    def reserve(self, nbytes):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+
+class AdaptiveConcurrencyLimit(_FifoAdmission):
+
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=100, backoff_ratio=0.5, decrease_seconds=1,
+                 clock=time.monotonic):
+        super().__init__()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._backoff_ratio = backoff_ratio
+        self._decrease_seconds = decrease_seconds
+        self._clock = clock
+        self._decreased_at = None
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _fits(self, amount):
+        return self.in_flight + amount <= self.limit
+
+    def record_success(self):
+        # Additive increase, about one more slot for every limit's worth of successful calls.
+        with self._lock:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._admit_waiters()
+
+    def record_failure(self):
+        # A burst of failures from calls already in flight is one congestion signal, the limit backs off once for it.
+        with self._lock:
+            now = self._clock()
+            if self._decreased_at is not None and now - self._decreased_at < self._decrease_seconds:
+                return
+            self._decreased_at = now
+            self._limit = max(self.min_limit, self._limit * self._backoff_ratio)
+
+
+class _NoMemoryBudget:
+
+    def acquire(self, nbytes):
+        pass
+
+    async def acquire_async(self, nbytes):
+        pass
+
+    def release(self, nbytes):
+        pass
+
+    @contextmanager
+    def reserve(self, nbytes):
+        yield
+
+
+NO_MEMORY_BUDGET = _NoMemoryBudget()
+
+
+def _read_memory_limit(path):
+    try:
+        with open(path) as limit_file:
+            limit = limit_file.read().strip()
+    except OSError:
+        return None
+    if not limit.isdigit() or int(limit) >= 2 ** 60:
+        return None
+    return int(limit)
+
+
+def available_memory(environ=os.environ):
+    if 'AWS_LAMBDA_FUNCTION_MEMORY_SIZE' in environ:
+        return int(environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']) * 2 ** 20
+    for path in _CGROUP_MEMORY_LIMITS:
+        limit = _read_memory_limit(path)
+        if limit is not None:
+            return limit
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+# The budget is per process. The worker only applies it in the parent, its build processes each hold one message.
+def load_memory_budget(environ=os.environ):
+    fraction = float(environ.get('MEMORY_BUDGET_FRACTION', 0))
+    if fraction <= 0:
+        return NO_MEMORY_BUDGET
+    return MemoryBudget(int(available_memory(environ) * fraction))
+
+
+def load_concurrency_limit(environ=os.environ):
+    max_limit = int(environ.get('ADAPTIVE_CONCURRENCY_MAX', 0))
+    if max_limit <= 0:
+        return None
+    return AdaptiveConcurrencyLimit(
+        initial_limit=int(environ.get('ADAPTIVE_CONCURRENCY_INITIAL', min(10, max_limit))),
+        max_limit=max_limit,
+        decrease_seconds=float(environ.get('ADAPTIVE_CONCURRENCY_DECREASE_SECONDS', 1)),
+    )
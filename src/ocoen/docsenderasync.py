@@ -0,0 +1,178 @@
+from functools import partial
+from ocoen.docsender import DocSender, _compress_attachment, _encode_tracking_token, _has_recipients, _log_metrics, \
+    _set_metric_attributes, _should_compress_attachment, _span_attributes, _timed
+from ocoen.docsenderadmission import estimate_send_bytes
+from ocoen.docsenderlambda import TokenKeyProvider
+from ulid import ulid
+
+import asyncio
+
+
+class AsyncTokenKeyProvider(TokenKeyProvider):
+
+    def __init__(self, kms_client, kms_key_id, s3_client, keys_bucket_name, keys_bucket_prefix,
+                 keys_bucket_storage_class):
+        super().__init__(kms_client, kms_key_id, None, keys_bucket_prefix, keys_bucket_storage_class)
+        self._s3 = s3_client
+        self._keys_bucket_name = keys_bucket_name
+        self._stateLock = None
+
+    async def get_key(self):
+        if self._stateLock is None:
+            self._stateLock = asyncio.Lock()
+        async with self._stateLock:
+            if self._state is None or self._state['remaining_uses'] <= 0:
+                self._state = await self._generate_key()
+            self._state['remaining_uses'] -= 1
+            return self._state['key']
+
+    async def _generate_key(self):
+        key_id = ulid()
+        response = await self._kms_client.generate_data_key(**self._data_key_request(key_id))
+        await self._s3.put_object(Bucket=self._keys_bucket_name, **self._key_object(key_id, response))
+        return self._key_state(key_id, response)
+
+
+class AsyncDocSender(DocSender):
+
+    def __init__(self, ses_client, s3_client, profile_bucket_name, attachment_bucket_name,
+                 token_key_provider=None, executor=None, **kwargs):
+        super().__init__(ses_client, None, None, token_key_provider, **kwargs)
+        self._s3 = s3_client
+        self._profile_bucket_name = profile_bucket_name
+        self._attachment_bucket_name = attachment_bucket_name
+        self._executor = executor
+
+    async def _run_in_executor(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args))
+
+    async def _guarded(self, service, call, **kwargs):
+        with self._guard(service):
+            return await call(**kwargs)
+
+    async def _get_object(self, bucket_name, key):
+        with self._guard('s3'):
+            response = await self._s3.get_object(Bucket=bucket_name, Key=key)
+            return response, await response['Body'].read()
+
+    async def _load_profile(self, profile_key):
+        _, profile_data = await self._get_object(self._profile_bucket_name, profile_key)
+        return self._parse_profile(profile_data)
+
+    async def _load_attachment(self, attachment_key, reservations=None):
+        response = await self._guarded('s3', self._s3.get_object, Bucket=self._attachment_bucket_name,
+                                       Key=attachment_key)
+        if reservations is not None:
+            nbytes = estimate_send_bytes(response.get('ContentLength'))
+            await self._memory_budget.acquire_async(nbytes)
+            reservations.append(nbytes)
+        with self._guard('s3'):
+            attachment_data = await response['Body'].read()
+        return attachment_data, response['ContentType'].split('/')
+
+    def _release(self, reservations):
+        for nbytes in reservations:
+            self._memory_budget.release(nbytes)
+
+    async def _create_tracking_token(self, **kwargs):
+        if self._token_key_provider is None:
+            return None
+        token_key = await self._guarded('kms', self._token_key_provider)
+        return await self._run_in_executor(_encode_tracking_token, token_key, kwargs)
+
+    async def _timed_stage(self, metrics, stage, coroutine, parent_span):
+        # Spans are never activated on the event loop thread, interleaved coroutines would see each other's spans.
+        with self._tracer.span(stage, parent=parent_span, activate=False), _timed(metrics, stage):
+            return await coroutine
+
+    def _render_email_in_span(self, span, *args):
+        with self._tracer.activate(span):
+            return self._render_email(*args)
+
+    async def build_email(self, profile_key, attachment_key, event, parent_span=None):
+        with self._tracer.span('build_email', parent=parent_span, activate=False,
+                               attributes=_span_attributes(profile_key, attachment_key)) as span:
+            reservations = []
+            try:
+                email, metrics = await self._build_email(profile_key, attachment_key, event, span, reservations)
+            finally:
+                self._release(reservations)
+            _set_metric_attributes(span, metrics)
+            return email, metrics
+
+    async def _build_email(self, profile_key, attachment_key, event, span, reservations=None):
+        if _has_recipients(event):
+            raise ValueError('Recipient lists are only supported by DocSender.send_email')
+        metrics = {}
+        loads = [
+            asyncio.ensure_future(self._timed_stage(metrics, 'load_profile', self._load_profile(profile_key), span)),
+            asyncio.ensure_future(self._timed_stage(
+                metrics, 'load_attachment', self._load_attachment(attachment_key, reservations), span
+            )),
+        ]
+        try:
+            profile, (attachment_data, attachment_type) = await asyncio.gather(*loads)
+        except BaseException:
+            # gather leaves the other load running, it must finish before its memory reservation is released.
+            for load in loads:
+                load.cancel()
+            await asyncio.gather(*loads, return_exceptions=True)
+            raise
+        attachment_suffix = ''
+        compression = profile.get('attachment_compression')
+        if compression is not None and _should_compress_attachment(
+                compression, '/'.join(attachment_type), len(attachment_data)):
+            attachment_data, attachment_type, attachment_suffix = await self._run_in_executor(
+                _compress_attachment, [attachment_data], attachment_key, compression, metrics
+            )
+        tracking_token = await self._timed_stage(metrics, 'create_tracking_token', self._create_tracking_token(
+            profile_key=profile_key,
+            profile=profile,
+            event=event
+        ), span)
+        email = await self._run_in_executor(
+            self._render_email_in_span, span, profile, event, attachment_data, attachment_type, tracking_token,
+            metrics, attachment_suffix
+        )
+        metrics['email_size'] = len(email)
+        metrics['attachment_size'] = len(attachment_data)
+        return email, metrics
+
+    async def send_raw_email(self, email, metrics=None, parent_span=None):
+        if metrics is None:
+            metrics = {}
+        await self._timed_stage(metrics, 'send_raw_email', self._guarded(
+            'ses', self._ses.send_raw_email, RawMessage={'Data': email},
+        ), parent_span)
+        return metrics
+
+    async def send_email(self, profile_key, attachment_key, event, parent_span=None):
+        with self._tracer.span('send_email', parent=parent_span, activate=False,
+                               attributes=_span_attributes(profile_key, attachment_key)) as span:
+            reservations = []
+            try:
+                email, metrics = await self._build_email(profile_key, attachment_key, event, span, reservations)
+                await self.send_raw_email(email, metrics, span)
+            finally:
+                self._release(reservations)
+            _set_metric_attributes(span, metrics)
+        _log_metrics(metrics)
+        return metrics
+
+    async def send_many(self, sends, max_in_flight=200):
+        in_flight = asyncio.Semaphore(max_in_flight)
+
+        async def send(profile_key, attachment_key, event):
+            async with in_flight:
+                if self._concurrency_limit is None:
+                    return await self.send_email(profile_key, attachment_key, event)
+                await self._concurrency_limit.acquire_async()
+                try:
+                    return await self.send_email(profile_key, attachment_key, event)
+                finally:
+                    self._concurrency_limit.release()
+
+        return await asyncio.gather(
+            *[send(profile_key, attachment_key, event) for profile_key, attachment_key, event in sends],
+            return_exceptions=True
+        )
@@ -0,0 +1,168 @@
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ['s3', 'kms', 'ses']
+
+_THROTTLING_CODES = frozenset([
+    'LimitExceededException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+])
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, name, retry_after):
+        super().__init__(name, retry_after)
+        self.name = name
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return 'Circuit {} is open, retry after {:.1f}s'.format(self.name, self.retry_after)
+
+
+def is_service_failure(error):
+    if isinstance(error, CircuitOpenError):
+        return True
+    if not isinstance(error, ClientError):
+        # Connection errors and timeouts, the service did not answer.
+        return True
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in _THROTTLING_CODES or (status is not None and status >= 500)
+
+
+class CircuitBreaker:
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, slow_call_seconds=None, reset_seconds=30, clock=time.monotonic):
+        self.name = name
+        self.state = CircuitBreaker.CLOSED
+        self._failure_threshold = failure_threshold
+        self._slow_call_seconds = slow_call_seconds
+        self._reset_seconds = reset_seconds
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._generation = 0
+        self._listeners = []
+        self._stateLock = threading.Lock()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, success):
+        for listener in self._listeners:
+            if success:
+                listener.record_success()
+            else:
+                listener.record_failure()
+
+    def _transition(self, state):
+        self.state = state
+        self._generation += 1
+
+    def _before_call(self):
+        with self._stateLock:
+            trial = False
+            if self.state == CircuitBreaker.OPEN:
+                retry_after = self._opened_at + self._reset_seconds - self._clock()
+                if retry_after > 0:
+                    rejected = CircuitOpenError(self.name, retry_after)
+                else:
+                    self._transition(CircuitBreaker.HALF_OPEN)
+                    self._trial_in_flight = trial = True
+                    rejected = None
+            elif self.state == CircuitBreaker.HALF_OPEN and self._trial_in_flight:
+                rejected = CircuitOpenError(self.name, 0)
+            else:
+                self._trial_in_flight = trial = self.state == CircuitBreaker.HALF_OPEN
+                rejected = None
+            admission = (self._generation, trial)
+        if rejected is not None:
+            self._notify(False)
+            raise rejected
+        return admission
+
+    def _after_call(self, admission, success):
+        generation, trial = admission
+        with self._stateLock:
+            if trial:
+                self._trial_in_flight = False
+            if success is None:
+                return
+            # Calls admitted before the last transition describe the service as it was, not as it is now.
+            if generation == self._generation:
+                if success:
+                    self._failures = 0
+                    if self.state != CircuitBreaker.CLOSED:
+                        logger.info('Circuit %s closed.', self.name)
+                        self._transition(CircuitBreaker.CLOSED)
+                else:
+                    self._failures += 1
+                    if self.state == CircuitBreaker.HALF_OPEN or (
+                            self.state == CircuitBreaker.CLOSED and self._failures >= self._failure_threshold):
+                        logger.warning('Circuit %s opened after %d failures.', self.name, self._failures)
+                        self._transition(CircuitBreaker.OPEN)
+                        self._opened_at = self._clock()
+        self._notify(success)
+
+    @contextmanager
+    def guard(self):
+        admission = self._before_call()
+        start_time = self._clock()
+        success = None
+        try:
+            yield
+        except Exception as e:
+            # Client errors such as NoSuchKey show the service is answering.
+            success = not is_service_failure(e)
+            raise
+        else:
+            success = self._slow_call_seconds is None or self._clock() - start_time <= self._slow_call_seconds
+        finally:
+            self._after_call(admission, success)
+
+
+class _NoCircuitBreaker:
+
+    @contextmanager
+    def guard(self):
+        yield
+
+    def add_listener(self, listener):
+        pass
+
+
+NO_CIRCUIT_BREAKER = _NoCircuitBreaker()
+
+
+def load_circuit_breakers(environ=os.environ):
+    failure_threshold = int(environ.get('CIRCUIT_BREAKER_FAILURES', 0))
+    if failure_threshold <= 0:
+        return {}
+    slow_call_seconds = environ.get('CIRCUIT_BREAKER_SLOW_SECONDS')
+    return {
+        service: CircuitBreaker(
+            service,
+            failure_threshold=failure_threshold,
+            slow_call_seconds=None if slow_call_seconds is None else float(slow_call_seconds),
+            reset_seconds=float(environ.get('CIRCUIT_BREAKER_RESET_SECONDS', 30)),
+        )
+        for service in SERVICES
+    }
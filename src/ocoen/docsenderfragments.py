@@ -0,0 +1,117 @@
+from botocore.exceptions import ClientError
+from collections import namedtuple
+from jinja2 import BaseLoader, TemplateNotFound
+from jinja2.loaders import split_template_path
+from jinja2.sandbox import SecurityError
+from ocoen.docsenderbreakers import NO_CIRCUIT_BREAKER, CircuitOpenError
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+Fragment = namedtuple('Fragment', ['source', 'etag', 'digest', 'checked_at'])
+
+
+class FragmentStore:
+
+    def __init__(self, bucket, prefix, ttl_seconds=60, clock=time.time, circuit_breaker=NO_CIRCUIT_BREAKER):
+        self._bucket = bucket
+        self._prefix = prefix
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._circuit_breaker = circuit_breaker
+        self._fragments = {}
+        self._compiled = {}
+        self._fragmentsLock = threading.Lock()
+
+    def fragment(self, name):
+        with self._fragmentsLock:
+            fragment = self._fragments.get(name)
+        if fragment is not None and self._clock() - fragment.checked_at < self._ttl_seconds:
+            return fragment
+        fragment = self._fetch(name, fragment)
+        with self._fragmentsLock:
+            previous = self._fragments.get(name)
+            self._fragments[name] = fragment
+            if previous is not None and previous.digest != fragment.digest:
+                logger.info('Fragment %s changed from %s to %s.', name, previous.digest, fragment.digest)
+                self._compiled = {
+                    key: code for key, code in self._compiled.items() if key[1] != name
+                }
+        return fragment
+
+    def _fetch(self, name, cached):
+        key = self._prefix + '/'.join(split_template_path(name))
+        try:
+            with self._circuit_breaker.guard():
+                if cached is None or cached.etag is None:
+                    response = self._bucket.Object(key).get()
+                else:
+                    response = self._bucket.Object(key).get(IfNoneMatch=cached.etag)
+        except (ClientError, CircuitOpenError) as e:
+            code = e.response['Error']['Code'] if isinstance(e, ClientError) else None
+            if code == '304':
+                return cached._replace(checked_at=self._clock())
+            if code in ('404', 'NoSuchKey'):
+                raise TemplateNotFound(name)
+            if cached is None:
+                raise
+            # A stale fragment is better than failing every send while S3 is unavailable.
+            logger.warning('Failed to revalidate fragment %s, using cached version.', name, exc_info=True)
+            return cached._replace(checked_at=self._clock())
+        source_data = response['Body'].read()
+        return Fragment(
+            source=source_data.decode('utf-8'),
+            etag=response.get('ETag'),
+            digest=hashlib.sha256(source_data).hexdigest(),
+            checked_at=self._clock(),
+        )
+
+    def is_current(self, name, digest):
+        try:
+            return self.fragment(name).digest == digest
+        except TemplateNotFound:
+            return False
+
+    def compiled(self, environment, name, fragment):
+        # Sandboxed and trusted environments generate different code for the same source.
+        key = (type(environment), name, fragment.digest)
+        with self._fragmentsLock:
+            code = self._compiled.get(key)
+        if code is None:
+            code = environment.compile(fragment.source, name)
+            with self._fragmentsLock:
+                self._compiled[key] = code
+        return code
+
+
+class FragmentLoader(BaseLoader):
+
+    def __init__(self, store, trusted_fragment_hashes=frozenset()):
+        self._store = store
+        self._trusted_fragment_hashes = trusted_fragment_hashes
+
+    def load(self, environment, name, globals=None):
+        if globals is None:
+            globals = {}
+        fragment = self._store.fragment(name)
+        # Fragments rendered outside the sandbox must be allowlisted, the same as the trusted profile including them.
+        if not getattr(environment, 'sandboxed', False) and fragment.digest not in self._trusted_fragment_hashes:
+            raise SecurityError('Fragment {} is not trusted'.format(name))
+        code = self._store.compiled(environment, name, fragment)
+        return environment.template_class.from_code(
+            environment, code, globals,
+            lambda: self._store.is_current(name, fragment.digest)
+        )
+
+
+def load_fragment_store(bucket, environ=os.environ, circuit_breaker=NO_CIRCUIT_BREAKER):
+    prefix = environ.get('FRAGMENTS_PREFIX')
+    if prefix is None:
+        return None
+    return FragmentStore(bucket, prefix, ttl_seconds=float(environ.get('FRAGMENTS_TTL_SECONDS', 60)),
+                         circuit_breaker=circuit_breaker)
@@ -0,0 +1,131 @@
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+
+import boto3
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def delivery_key(sns_record, profile_key, result_key, sns_event):
+    message_id = sns_record.get('MessageId')
+    if message_id:
+        return 'sns/' + message_id
+    event_hash = hashlib.sha256(json.dumps(sns_event, sort_keys=True).encode('utf-8')).hexdigest()
+    return 'event/{}/{}/{}'.format(profile_key, result_key, event_hash)
+
+
+def _hashed_key(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class NoIdempotencyStore:
+
+    def is_delivered(self, key):
+        return False
+
+    def mark_delivered(self, key):
+        pass
+
+
+class MemoryIdempotencyStore:
+
+    def __init__(self, max_size=10000):
+        self._max_size = max_size
+        self._delivered = OrderedDict()
+        self._deliveredLock = threading.Lock()
+
+    def is_delivered(self, key):
+        with self._deliveredLock:
+            if key in self._delivered:
+                self._delivered.move_to_end(key)
+                return True
+            return False
+
+    def mark_delivered(self, key):
+        with self._deliveredLock:
+            self._delivered[key] = True
+            self._delivered.move_to_end(key)
+            while len(self._delivered) > self._max_size:
+                self._delivered.popitem(last=False)
+
+
+class FileIdempotencyStore:
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, _hashed_key(key))
+
+    def is_delivered(self, key):
+        return os.path.exists(self._path(key))
+
+    def mark_delivered(self, key):
+        with open(self._path(key), 'w') as marker:
+            marker.write(key)
+
+
+class S3IdempotencyStore:
+
+    def __init__(self, bucket, prefix=''):
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _key(self, key):
+        return '{}docsender_delivered/{}'.format(self._prefix, _hashed_key(key))
+
+    def is_delivered(self, key):
+        try:
+            self._bucket.Object(self._key(key)).load()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def mark_delivered(self, key):
+        self._bucket.put_object(
+            Key=self._key(key),
+            Body=key.encode('utf-8'),
+            ServerSideEncryption='AES256',
+        )
+
+
+class DynamoDBIdempotencyStore:
+
+    def __init__(self, table, ttl_seconds=7 * 24 * 60 * 60):
+        self._table = table
+        self._ttl_seconds = ttl_seconds
+
+    def is_delivered(self, key):
+        response = self._table.get_item(Key={'delivery_key': key}, ConsistentRead=True)
+        item = response.get('Item')
+        return item is not None and item.get('expires_at', float('inf')) > time.time()
+
+    def mark_delivered(self, key):
+        self._table.put_item(Item={
+            'delivery_key': key,
+            'expires_at': int(time.time()) + self._ttl_seconds,
+        })
+
+
+def load_idempotency_store(environ=os.environ):
+    store_info = environ.get('IDEMPOTENCY_STORE', '').split(':')
+    store_type = store_info[0]
+    if store_type == '':
+        return NoIdempotencyStore()
+    if store_type == 'memory':
+        return MemoryIdempotencyStore(*[int(size) for size in store_info[1:2]])
+    if store_type == 'file':
+        return FileIdempotencyStore(':'.join(store_info[1:]))
+    if store_type == 's3':
+        bucket = boto3.session.Session(region_name=store_info[1]).resource('s3').Bucket(store_info[2])
+        return S3IdempotencyStore(bucket, *store_info[3:4])
+    if store_type == 'dynamodb':
+        table = boto3.session.Session(region_name=store_info[1]).resource('dynamodb').Table(store_info[2])
+        return DynamoDBIdempotencyStore(table, *[int(ttl) for ttl in store_info[3:4]])
+    raise ValueError('IDEMPOTENCY_STORE must be memory, file, s3 or dynamodb but was ' + store_type)
@@ -1,6 +1,13 @@
+from collections import OrderedDict
 from jwcrypto import jwk
 from jwcrypto.common import base64url_encode
-from ocoen.docsender import DocSender
+from ocoen.docsender import DEFAULT_RENDER_LIMITS, DocSender, RenderLimits
+from ocoen.docsenderadmission import load_concurrency_limit, load_memory_budget
+from ocoen.docsenderbreakers import NO_CIRCUIT_BREAKER, load_circuit_breakers
+from ocoen.docsenderfragments import load_fragment_store
+from ocoen.docsenderidempotency import delivery_key, load_idempotency_store
+from ocoen.docsenderprofiling import SampledProfiler
+from ocoen.docsendertracing import load_tracer, sns_trace_context
 from ulid import ulid
 
 import boto3
@@ -8,11 +15,13 @@ import json
 import logging
 import os
 import threading
+import yaml
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 _docsender = None
+_idempotency_store = None
 
 
 class TokenKeyProvider:
@@ -35,32 +44,72 @@ class TokenKeyProvider:
 
     def _generate_key(self):
         key_id = ulid()
-        response = self._kms_client.generate_data_key(
-            KeyId=self._kms_key_id,
-            KeySpec='AES_256',
-            EncryptionContext={
+        response = self._kms_client.generate_data_key(**self._data_key_request(key_id))
+        self._keys_bucket.put_object(**self._key_object(key_id, response))
+        return self._key_state(key_id, response)
+
+    def _data_key_request(self, key_id):
+        return {
+            'KeyId': self._kms_key_id,
+            'KeySpec': 'AES_256',
+            'EncryptionContext': {
                 'key_id': key_id,
                 'key_role': 'docsender_tracking_token',
-            }
-        )
-        self._keys_bucket.put_object(
-            Key='{}docsender_tracking_token/{}'.format(
+            },
+        }
+
+    def _key_object(self, key_id, response):
+        return {
+            'Key': '{}docsender_tracking_token/{}'.format(
                 self._keys_bucket_prefix,
                 key_id
             ),
-            Body=response['CiphertextBlob'],
-            ServerSideEncryption='AES256',
-            StorageClass=self._keys_bucket_storage_class,
-        )
+            'Body': response['CiphertextBlob'],
+            'ServerSideEncryption': 'AES256',
+            'StorageClass': self._keys_bucket_storage_class,
+        }
+
+    def _key_state(self, key_id, response):
         return {
             'remaining_uses': 2 ** 24,
             'key': jwk.JWK(kty='oct', kid=key_id, k=base64url_encode(response['Plaintext'])),
         }
 
 
-def load_docsender():
+def load_ses_client():
     ses_region = os.environ['SES_REGION']
-    ses = boto3.session.Session(region_name=ses_region).client('ses')
+    return boto3.session.Session(region_name=ses_region).client('ses')
+
+
+def load_render_limits():
+    return RenderLimits(
+        max_seconds=float(os.environ.get('RENDER_MAX_SECONDS', DEFAULT_RENDER_LIMITS.max_seconds)),
+        max_output_size=int(os.environ.get('RENDER_MAX_OUTPUT_SIZE', DEFAULT_RENDER_LIMITS.max_output_size)),
+        max_loop_iterations=int(os.environ.get('RENDER_MAX_LOOP_ITERATIONS',
+                                               DEFAULT_RENDER_LIMITS.max_loop_iterations)),
+    )
+
+
+def load_trusted_profile_hashes():
+    return [digest.strip() for digest in os.environ.get('TRUSTED_PROFILE_HASHES', '').split(',') if digest.strip()]
+
+
+def load_warm_up_profile_keys(profiles_bucket, circuit_breaker=NO_CIRCUIT_BREAKER):
+    if 'WARMUP_PROFILES' not in os.environ and 'WARMUP_MANIFEST' not in os.environ:
+        return None
+    profile_keys = [key.strip() for key in os.environ.get('WARMUP_PROFILES', '').split(',') if key.strip()]
+    if 'WARMUP_MANIFEST' in os.environ:
+        try:
+            with circuit_breaker.guard():
+                manifest = profiles_bucket.Object(os.environ['WARMUP_MANIFEST']).get()['Body'].read()
+            profile_keys.extend(yaml.safe_load(manifest) or [])
+        except Exception:
+            logger.exception('Failed to load warm up manifest %s.', os.environ['WARMUP_MANIFEST'])
+    return list(OrderedDict.fromkeys(profile_keys))
+
+
+def load_docsender():
+    ses = load_ses_client()
 
     token_kms_key_info = os.environ['TOKEN_KMS_KEY'].split(':', 1)
     kms_client = boto3.session.Session(region_name=token_kms_key_info[0]).client('kms')
@@ -84,16 +133,47 @@ def load_docsender():
 
     token_key_manager = TokenKeyProvider(kms_client, token_kms_key_info[1],
                                          keys_bucket, keys_bucket_prefix, keys_bucket_storage_class)
-    return DocSender(ses, profiles_bucket, results_bucket, token_key_manager.get_key)
+    circuit_breakers = load_circuit_breakers()
+    s3_circuit_breaker = circuit_breakers.get('s3', NO_CIRCUIT_BREAKER)
+    docsender = DocSender(ses, profiles_bucket, results_bucket, token_key_manager.get_key,
+                          render_limits=load_render_limits(), profiler=SampledProfiler.from_environ(),
+                          tracer=load_tracer(), trusted_profile_hashes=load_trusted_profile_hashes(),
+                          memory_budget=load_memory_budget(),
+                          fragments=load_fragment_store(profiles_bucket, circuit_breaker=s3_circuit_breaker),
+                          circuit_breakers=circuit_breakers, concurrency_limit=load_concurrency_limit())
+    warm_up_profile_keys = load_warm_up_profile_keys(profiles_bucket, s3_circuit_breaker)
+    if warm_up_profile_keys is not None:
+        docsender.warm_up(warm_up_profile_keys)
+    return docsender
+
+
+def parse_sns_message(message):
+    sns_event = json.loads(message)
+    return sns_event['profile_key'], sns_event['result_key'], sns_event
 
 
 def handle_event(event, context):
-    global _docsender
+    global _docsender, _idempotency_store
     if _docsender is None:
         _docsender = load_docsender()
-
-    sns_event = json.loads(event['Records'][0]['Sns']['Message'])
-    profile_key = sns_event['profile_key']
-    attachment_key = sns_event['result_key']
-
-    _docsender.send_email(profile_key, attachment_key, sns_event)
+    if _idempotency_store is None:
+        _idempotency_store = load_idempotency_store()
+
+    sns_record = event['Records'][0]['Sns']
+    profile_key, attachment_key, sns_event = parse_sns_message(sns_record['Message'])
+    with _docsender.tracer.span('handle_event', parent=sns_trace_context(sns_record), attributes={
+        'sns_message_id': sns_record.get('MessageId'),
+    }) as span:
+        key = delivery_key(sns_record, profile_key, attachment_key, sns_event)
+        if _idempotency_store.is_delivered(key):
+            logger.info('Skipping already delivered message %s.', key)
+            span.set_attribute('already_delivered', True)
+            return
+        metrics = _docsender.send_email(profile_key, attachment_key, sns_event)
+        try:
+            _idempotency_store.mark_delivered(key)
+        except Exception:
+            # Failing the event now would have SNS redeliver a message that was already sent.
+            logger.exception('Failed to mark message %s delivered.', key)
+            span.set_attribute('mark_delivered_failed', True)
+        return metrics
@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+class _NotSampled:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOT_SAMPLED = _NotSampled()
+
+
+class SampledProfiler:
+
+    def __init__(self, sample_rate, top_n=15, random_source=random.random):
+        self._sample_rate = sample_rate
+        self._top_n = top_n
+        self._random = random_source
+        # Only one invocation is profiled at a time, cProfile and tracemalloc are process wide on newer Pythons.
+        self._profiling = threading.Lock()
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        return cls(
+            sample_rate=float(environ.get('PROFILE_SAMPLE_RATE', 0)),
+            top_n=int(environ.get('PROFILE_TOP_N', 15)),
+        )
+
+    def profile(self, tag):
+        if self._sample_rate <= 0 or self._random() >= self._sample_rate:
+            return _NOT_SAMPLED
+        if not self._profiling.acquire(blocking=False):
+            return _NOT_SAMPLED
+        return self._profile(tag)
+
+    @contextmanager
+    def _profile(self, tag):
+        try:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            snapshot_start = tracemalloc.take_snapshot()
+            profiler = cProfile.Profile()
+            time_start = time.time()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                elapsed = time.time() - time_start
+                snapshot_end = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+                logger.info(self._summarise(tag, elapsed, profiler, snapshot_start, snapshot_end))
+        finally:
+            self._profiling.release()
+
+    def _summarise(self, tag, elapsed, profiler, snapshot_start, snapshot_end):
+        lines = ['profile {}: {:.3f}s'.format(tag, elapsed), 'top functions (tottime cumtime calls):']
+        stats = pstats.Stats(profiler).stats
+        hot_functions = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self._top_n]
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in hot_functions:
+            lines.append('  {:.4f}s {:.4f}s {} {}:{}({})'.format(
+                tottime, cumtime, calls, _short_path(filename), line, function))
+
+        lines.append('top allocations (size count):')
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        allocations = snapshot_end.filter_traces(ignore).compare_to(snapshot_start.filter_traces(ignore), 'lineno')
+        allocations = [allocation for allocation in allocations if allocation.size_diff > 0]
+        for allocation in allocations[:self._top_n]:
+            frame = allocation.traceback[0]
+            lines.append('  {:+.1f}KiB {:+d} {}:{}'.format(
+                allocation.size_diff / 1024, allocation.count_diff, _short_path(frame.filename), frame.lineno))
+        return '\n'.join(lines)
+
+
+def _short_path(filename):
+    parts = filename.replace(os.sep, '/').rsplit('/', 2)
+    return '/'.join(parts[-2:])
+
+
+NO_PROFILER = SampledProfiler(0)
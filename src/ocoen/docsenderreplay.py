@@ -0,0 +1,326 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from ocoen.docsender import DocSender
+from ocoen.docsenderadmission import load_concurrency_limit, load_memory_budget
+from ocoen.docsenderbreakers import NO_CIRCUIT_BREAKER, load_circuit_breakers
+from ocoen.docsenderfragments import load_fragment_store
+from ocoen.docsenderidempotency import NoIdempotencyStore
+from ocoen.docsenderlambda import TokenKeyProvider, load_render_limits, load_trusted_profile_hashes
+from ocoen.docsenderprofiling import SampledProfiler
+from ocoen.docsendertracing import load_tracer
+from ulid import ulid
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mimetypes
+import ocoen.docsenderlambda
+import os
+import random
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Latency:
+
+    def __init__(self, seconds=0.0, jitter=0.0, random_source=random.uniform):
+        self._seconds = seconds
+        self._jitter = jitter
+        self._random = random_source
+
+    def wait(self):
+        if self._seconds <= 0:
+            return
+        delay = self._seconds
+        if self._jitter > 0:
+            delay *= self._random(1 - self._jitter, 1 + self._jitter)
+        time.sleep(delay)
+
+
+NO_LATENCY = Latency()
+
+
+class _LocalObject:
+
+    def __init__(self, bucket, key):
+        self._bucket = bucket
+        self._key = key
+
+    def get(self, IfNoneMatch=None):
+        self._bucket.latency.wait()
+        data = self._bucket.read(self._key)
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {
+            'Body': BytesIO(data),
+            'ContentLength': len(data),
+            'ContentType': mimetypes.guess_type(self._key)[0] or 'application/octet-stream',
+            'ETag': etag,
+        }
+
+
+class LocalBucket:
+
+    def __init__(self, directory=None, latency=NO_LATENCY):
+        self._directory = directory
+        self.latency = latency
+        self.objects = {}
+        self._objectsLock = threading.Lock()
+
+    def Object(self, key):
+        return _LocalObject(self, key)
+
+    def read(self, key):
+        with self._objectsLock:
+            if key in self.objects:
+                return self.objects[key]
+        path = None if self._directory is None else os.path.join(self._directory, key)
+        if path is None or not os.path.isfile(path):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, 'GetObject')
+        with open(path, 'rb') as object_file:
+            return object_file.read()
+
+    def put_object(self, Key, Body, **kwargs):
+        self.latency.wait()
+        with self._objectsLock:
+            self.objects[Key] = Body
+
+
+class LocalKms:
+
+    def __init__(self, latency=NO_LATENCY):
+        self._latency = latency
+
+    def generate_data_key(self, KeyId, KeySpec, EncryptionContext):
+        self._latency.wait()
+        plaintext = os.urandom(32)
+        return {
+            'KeyId': KeyId,
+            'Plaintext': plaintext,
+            'CiphertextBlob': plaintext[::-1],
+        }
+
+
+class LocalSes:
+
+    def __init__(self, latency=NO_LATENCY, eml_directory=None):
+        self._latency = latency
+        self._eml_directory = eml_directory
+        if eml_directory is not None:
+            os.makedirs(eml_directory, exist_ok=True)
+
+    def send_raw_email(self, RawMessage):
+        self._latency.wait()
+        message_id = ulid()
+        if self._eml_directory is not None:
+            with open(os.path.join(self._eml_directory, message_id + '.eml'), 'wb') as eml_file:
+                eml_file.write(RawMessage['Data'])
+        return {'MessageId': message_id}
+
+
+def load_local_docsender(profiles_directory, results_directory, s3_latency=NO_LATENCY, kms_latency=NO_LATENCY,
+                         ses_latency=NO_LATENCY, eml_directory=None):
+    token_key_manager = TokenKeyProvider(LocalKms(kms_latency), 'replay', LocalBucket(latency=s3_latency), '',
+                                         'STANDARD')
+    profiles_bucket = LocalBucket(profiles_directory, s3_latency)
+    circuit_breakers = load_circuit_breakers()
+    return DocSender(LocalSes(ses_latency, eml_directory),
+                     profiles_bucket,
+                     LocalBucket(results_directory, s3_latency),
+                     token_key_manager.get_key,
+                     render_limits=load_render_limits(), profiler=SampledProfiler.from_environ(),
+                     tracer=load_tracer(), trusted_profile_hashes=load_trusted_profile_hashes(),
+                     memory_budget=load_memory_budget(),
+                     fragments=load_fragment_store(
+                         profiles_bucket, circuit_breaker=circuit_breakers.get('s3', NO_CIRCUIT_BREAKER)),
+                     circuit_breakers=circuit_breakers, concurrency_limit=load_concurrency_limit())
+
+
+def _lambda_events(record):
+    if 'Records' in record:
+        for lambda_record in record['Records']:
+            yield {'Records': [lambda_record]}
+    elif 'Sns' in record:
+        yield {'Records': [record]}
+    elif 'Message' in record:
+        yield {'Records': [{'Sns': record}]}
+    else:
+        yield {'Records': [{'Sns': {'Message': json.dumps(record)}}]}
+
+
+def read_jsonl_events(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield from _lambda_events(json.loads(line))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(fraction * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+class ReplayStats:
+
+    STAGES = ['queue_wait'] + DocSender.STAGES + ['handle_event']
+    PERCENTILES = [0.5, 0.9, 0.99]
+
+    def __init__(self):
+        self.received = 0
+        self.sent = 0
+        self.skipped = 0
+        self.errors = {}
+        self.bytes_sent = 0
+        self.latencies = {stage: [] for stage in ReplayStats.STAGES}
+        self.start_time = time.time()
+        self.end_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def failed(self):
+        return sum(self.errors.values())
+
+    def record(self, queue_wait, elapsed, metrics):
+        with self._lock:
+            self.latencies['queue_wait'].append(queue_wait)
+            self.latencies['handle_event'].append(elapsed)
+            if metrics is None:
+                self.skipped += 1
+                return
+            self.sent += 1
+            self.bytes_sent += metrics.get('email_size', 0)
+            for stage in DocSender.STAGES:
+                if stage in metrics:
+                    self.latencies[stage].append(metrics[stage])
+
+    def record_error(self, queue_wait, elapsed, error):
+        with self._lock:
+            self.latencies['queue_wait'].append(queue_wait)
+            self.latencies['handle_event'].append(elapsed)
+            error_type = type(error).__name__
+            self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def format(self):
+        elapsed = (self.end_time or time.time()) - self.start_time
+        completed = self.sent + self.skipped + self.failed
+        lines = [
+            'Replayed {} events in {:.1f}s: {} sent, {} skipped, {} failed.'.format(
+                self.received, elapsed, self.sent, self.skipped, self.failed),
+            'Throughput: {:.2f} messages/s, {:.2f} MB/s.'.format(
+                self.sent / elapsed if elapsed else 0,
+                self.bytes_sent / elapsed / 2 ** 20 if elapsed else 0),
+            'Error rate: {:.2%}'.format(self.failed / completed if completed else 0),
+        ]
+        for error_type, count in sorted(self.errors.items()):
+            lines.append('  {} {}'.format(error_type, count))
+        lines.append('{:<24} {:>8} {}'.format('stage', 'count', ' '.join(
+            '{:>9}'.format('p{:g}'.format(fraction * 100)) for fraction in ReplayStats.PERCENTILES + [1])))
+        for stage in ReplayStats.STAGES:
+            values = sorted(self.latencies[stage])
+            if values:
+                lines.append('{:<24} {:>8} {}'.format(stage, len(values), ' '.join(
+                    '{:>8.1f}ms'.format(percentile(values, fraction) * 1000)
+                    for fraction in ReplayStats.PERCENTILES + [1])))
+        return '\n'.join(lines)
+
+
+class Replayer:
+
+    def __init__(self, executor, concurrency, rate=0.0, handle_event=None):
+        self._executor = executor
+        self._rate = rate
+        self._handle_event = handle_event or ocoen.docsenderlambda.handle_event
+        # Without an arrival rate events are replayed closed loop, as fast as the concurrency allows.
+        self._in_flight = threading.BoundedSemaphore(concurrency)
+        self.stats = ReplayStats()
+
+    def run(self, events):
+        futures = []
+        self.stats.start_time = time.time()
+        for index, event in enumerate(events):
+            if self._rate > 0:
+                arrival_time = self.stats.start_time + index / self._rate
+                delay = arrival_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                self._in_flight.acquire()
+                arrival_time = time.time()
+            self.stats.received += 1
+            futures.append(self._executor.submit(self._replay, event, arrival_time))
+        for future in futures:
+            future.result()
+        self.stats.end_time = time.time()
+        return self.stats
+
+    def _replay(self, event, arrival_time):
+        start_time = time.time()
+        try:
+            metrics = self._handle_event(event, None)
+        except Exception as e:
+            logger.debug('Failed to replay event.', exc_info=True)
+            self.stats.record_error(start_time - arrival_time, time.time() - start_time, e)
+        else:
+            self.stats.record(start_time - arrival_time, time.time() - start_time, metrics)
+        finally:
+            if self._rate <= 0:
+                self._in_flight.release()
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Replay recorded SNS events through handle_event against local S3, KMS and SES stand-ins.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='JSONL file of Lambda SNS events or SNS messages, or - for stdin (default).')
+    parser.add_argument('--profiles-dir', required=True, help='Directory standing in for the profiles bucket.')
+    parser.add_argument('--results-dir', required=True, help='Directory standing in for the results bucket.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of events handled at once.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Arrival rate in events per second, replays as fast as possible when 0 (default).')
+    parser.add_argument('--s3-latency', type=float, default=0, help='Seconds added to each S3 request.')
+    parser.add_argument('--kms-latency', type=float, default=0, help='Seconds added to each KMS request.')
+    parser.add_argument('--ses-latency', type=float, default=0, help='Seconds added to each SES request.')
+    parser.add_argument('--latency-jitter', type=float, default=0,
+                        help='Fraction the injected latencies vary by, uniformly distributed.')
+    parser.add_argument('--eml-dir', help='Write the raw messages sent to SES as .eml files in this directory.')
+    parser.add_argument('--log-level', default='WARNING', help='Log level while replaying.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.getLogger().setLevel(args.log_level)
+
+    ocoen.docsenderlambda._docsender = load_local_docsender(
+        args.profiles_dir,
+        args.results_dir,
+        s3_latency=Latency(args.s3_latency, args.latency_jitter),
+        kms_latency=Latency(args.kms_latency, args.latency_jitter),
+        ses_latency=Latency(args.ses_latency, args.latency_jitter),
+        eml_directory=args.eml_dir,
+    )
+    ocoen.docsenderlambda._idempotency_store = NoIdempotencyStore()
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        replayer = Replayer(executor, args.concurrency, args.rate)
+        if args.input == '-':
+            stats = replayer.run(read_jsonl_events(sys.stdin))
+        else:
+            with open(args.input) as input_file:
+                stats = replayer.run(read_jsonl_events(input_file))
+
+    print(stats.format())
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+import importlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SpanContext = namedtuple('SpanContext', ['trace_id', 'span_id', 'sampled'])
+
+_TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+_XRAY_ROOT = re.compile(r'^1-([0-9a-f]{8})-([0-9a-f]{24})$')
+_XRAY_PARENT = re.compile(r'^[0-9a-f]{16}$')
+
+
+def parse_traceparent(traceparent):
+    match = _TRACEPARENT.match(traceparent.strip().lower())
+    if match is None or match.group(1) == 'ff' or set(match.group(2)) == {'0'} or set(match.group(3)) == {'0'}:
+        return None
+    return SpanContext(match.group(2), match.group(3), bool(int(match.group(4), 16) & 1))
+
+
+def parse_xray_trace_header(trace_header):
+    fields = dict(
+        field.strip().split('=', 1) for field in trace_header.split(';') if '=' in field
+    )
+    root = _XRAY_ROOT.match(fields.get('Root', '').lower())
+    parent = fields.get('Parent', '').lower()
+    if root is None or not _XRAY_PARENT.match(parent):
+        return None
+    return SpanContext(root.group(1) + root.group(2), parent, fields.get('Sampled', '1') != '0')
+
+
+def sns_trace_context(sns_record):
+    attributes = sns_record.get('MessageAttributes') or {}
+    if 'traceparent' in attributes:
+        return parse_traceparent(attributes['traceparent']['Value'])
+    if 'AWSTraceHeader' in attributes:
+        return parse_xray_trace_header(attributes['AWSTraceHeader']['Value'])
+    return None
+
+
+class Span:
+
+    def __init__(self, name, trace_id, span_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def context(self):
+        return SpanContext(self.trace_id, self.span_id, True)
+
+    @property
+    def traceparent(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    @property
+    def duration(self):
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class NoopTracer:
+
+    def current_span(self):
+        return None
+
+    def span(self, name, parent=None, attributes=None, activate=True):
+        return _NOOP_SPAN
+
+    def activate(self, span):
+        return _NOOP_SPAN
+
+
+class Tracer:
+
+    def __init__(self, exporters):
+        self._exporters = list(exporters)
+        self._local = threading.local()
+
+    def current_span(self):
+        return getattr(self._local, 'span', None)
+
+    @contextmanager
+    def activate(self, span):
+        previous = self.current_span()
+        self._local.span = span
+        try:
+            yield span
+        finally:
+            self._local.span = previous
+
+    @contextmanager
+    def span(self, name, parent=None, attributes=None, activate=True):
+        if parent is None:
+            parent = self.current_span()
+        if isinstance(parent, Span):
+            parent = parent.context
+        if parent is None:
+            span = Span(name, os.urandom(16).hex(), os.urandom(8).hex(), None, attributes)
+        else:
+            span = Span(name, parent.trace_id, os.urandom(8).hex(), parent.span_id, attributes)
+
+        previous = self.current_span()
+        if activate:
+            self._local.span = span
+        try:
+            yield span
+        except BaseException as e:
+            span.status = 'error'
+            span.set_attribute('error', type(e).__name__)
+            raise
+        finally:
+            if activate:
+                self._local.span = previous
+            span.end_time = time.time()
+            self._export(span)
+
+    def _export(self, span):
+        for exporter in self._exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                logger.exception('Failed to export span %s with %s.', span.name, exporter)
+
+
+class LoggingSpanExporter:
+
+    def __init__(self, level=logging.INFO):
+        self._level = level
+
+    def export(self, span):
+        logger.log(self._level, json.dumps(span.to_dict(), sort_keys=True, default=str))
+
+
+class InMemorySpanExporter:
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+NOOP_TRACER = NoopTracer()
+
+_EXPORTERS = {
+    'log': LoggingSpanExporter,
+}
+
+
+def _load_exporter(name):
+    if name in _EXPORTERS:
+        return _EXPORTERS[name]()
+    if ':' in name:
+        module_name, class_name = name.split(':', 1)
+        return getattr(importlib.import_module(module_name), class_name)()
+    raise ValueError('Tracing exporters must be one of {} or module:Class but was {}'.format(sorted(_EXPORTERS), name))
+
+
+def load_tracer(environ=os.environ):
+    exporter_names = [name.strip() for name in environ.get('TRACING_EXPORTERS', '').split(',') if name.strip()]
+    if not exporter_names:
+        return NOOP_TRACER
+    return Tracer([_load_exporter(name) for name in exporter_names])
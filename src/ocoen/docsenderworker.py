@@ -0,0 +1,279 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from ocoen.docsender import DocSender
+from ocoen.docsenderadmission import NO_MEMORY_BUDGET, AdaptiveConcurrencyLimit, estimate_send_bytes, \
+    load_memory_budget
+from ocoen.docsenderbreakers import CircuitBreaker, CircuitOpenError, is_service_failure, load_circuit_breakers
+from ocoen.docsenderlambda import load_docsender, load_ses_client, parse_sns_message
+
+import argparse
+import boto3
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_docsender = None
+
+
+class BuildError(Exception):
+
+    def __init__(self, description, code=None, status=None, circuit_open=False, service_failure=False):
+        super().__init__(description, code, status, circuit_open, service_failure)
+        self.description = description
+        self.code = code
+        self.status = status
+        self.circuit_open = circuit_open
+        self.service_failure = service_failure
+
+    def __str__(self):
+        return self.description
+
+
+def _build_error(error):
+    # Build errors are pickled back to the parent and not every botocore exception can be unpickled.
+    description = '{}: {}'.format(type(error).__name__, error)
+    if isinstance(error, CircuitOpenError):
+        return BuildError(description, circuit_open=True, service_failure=True)
+    if isinstance(error, ClientError):
+        return BuildError(
+            description,
+            code=error.response.get('Error', {}).get('Code'),
+            status=error.response.get('ResponseMetadata', {}).get('HTTPStatusCode'),
+            service_failure=is_service_failure(error),
+        )
+    return BuildError(description)
+
+
+def _build_email(message):
+    global _docsender
+    if _docsender is None:
+        # The parent process owns shutdown, children finish their current message and exit when the pool is drained.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # A child only builds one message at a time, the memory budget is applied to the sends in the parent.
+        os.environ.pop('MEMORY_BUDGET_FRACTION', None)
+        _docsender = load_docsender()
+
+    try:
+        profile_key, attachment_key, sns_event = parse_sns_message(message)
+        return _docsender.build_email(profile_key, attachment_key, sns_event)
+    except Exception as e:
+        raise _build_error(e) from e
+
+
+def _sns_messages(record):
+    if 'Records' in record:
+        for lambda_record in record['Records']:
+            yield lambda_record['Sns']['Message']
+    elif 'Sns' in record:
+        yield record['Sns']['Message']
+    elif 'Message' in record:
+        yield record['Message']
+    else:
+        yield json.dumps(record)
+
+
+def read_jsonl_messages(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            for message in _sns_messages(json.loads(line)):
+                yield message, None
+
+
+def read_sqs_messages(sqs_client, queue_url, stop_event, wait_time_seconds=20):
+    while not stop_event.is_set():
+        response = sqs_client.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=wait_time_seconds,
+        )
+        for sqs_message in response.get('Messages', []):
+            ack = partial(sqs_client.delete_message, QueueUrl=queue_url, ReceiptHandle=sqs_message['ReceiptHandle'])
+            for message in _sns_messages(json.loads(sqs_message['Body'])):
+                yield message, ack
+
+
+class WorkerStats:
+
+    def __init__(self):
+        self.received = 0
+        self.sent = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.stage_totals = {}
+        self.start_time = time.time()
+        self.end_time = None
+        self._lock = threading.Lock()
+
+    def record_success(self, metrics):
+        with self._lock:
+            self.sent += 1
+            self.bytes_sent += metrics.get('email_size', 0)
+            for stage in DocSender.STAGES:
+                if stage in metrics:
+                    self.stage_totals[stage] = self.stage_totals.get(stage, 0) + metrics[stage]
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def format(self):
+        elapsed = (self.end_time or time.time()) - self.start_time
+        lines = [
+            'Processed {} messages in {:.1f}s: {} sent, {} failed.'.format(
+                self.received, elapsed, self.sent, self.failed),
+            'Throughput: {:.2f} messages/s, {:.2f} MB/s.'.format(
+                self.sent / elapsed if elapsed else 0,
+                self.bytes_sent / elapsed / 2 ** 20 if elapsed else 0),
+        ]
+        if self.sent:
+            lines.append('Mean stage timings: ' + ', '.join(
+                '{} {:.3f}s'.format(stage, total / self.sent) for stage, total in self.stage_totals.items()
+            ))
+        return '\n'.join(lines)
+
+
+class Worker:
+
+    def __init__(self, build_executor, send_executor, send_raw_email, max_in_flight, concurrency_limit=None,
+                 memory_budget=NO_MEMORY_BUDGET):
+        self._build_executor = build_executor
+        self._send_executor = send_executor
+        self._send_raw_email = send_raw_email
+        self._max_in_flight = max_in_flight
+        self._concurrency_limit = concurrency_limit
+        self._memory_budget = memory_budget
+        self._in_flight = 0
+        self._in_flight_changed = threading.Condition()
+        self._stop_event = threading.Event()
+        self.stats = WorkerStats()
+
+    @property
+    def stop_event(self):
+        return self._stop_event
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self, messages):
+        self.stats.start_time = time.time()
+        for message, ack in messages:
+            if self._stop_event.is_set():
+                break
+            self._submit(message, ack)
+        self._drain()
+        self.stats.end_time = time.time()
+        return self.stats
+
+    def _submit(self, message, ack):
+        with self._in_flight_changed:
+            self._in_flight_changed.wait_for(lambda: self._in_flight < self._max_in_flight)
+            self._in_flight += 1
+        if self._concurrency_limit is not None:
+            self._concurrency_limit.acquire()
+        self.stats.received += 1
+        build_future = self._build_executor.submit(_build_email, message)
+        build_future.add_done_callback(partial(self._built, ack))
+
+    def _built(self, ack, build_future):
+        try:
+            email, metrics = build_future.result()
+        except Exception as e:
+            logger.exception('Failed to build email.')
+            if self._concurrency_limit is not None and _is_backoff_error(e):
+                # The breakers in the build processes cannot reach this limit, their rejections and throttling can.
+                self._concurrency_limit.record_failure()
+            self._finish(False)
+            return
+        self._send_executor.submit(self._send, email, metrics, ack)
+
+    def _send(self, email, metrics, ack):
+        try:
+            with self._memory_budget.reserve(estimate_send_bytes(metrics.get('attachment_size'))):
+                self._send_raw_email(email, metrics)
+            if ack is not None:
+                ack()
+        except Exception:
+            logger.exception('Failed to send email.')
+            self._finish(False)
+        else:
+            self._finish(True, metrics)
+
+    def _finish(self, success, metrics=None):
+        if success:
+            self.stats.record_success(metrics)
+        else:
+            self.stats.record_failure()
+        if self._concurrency_limit is not None:
+            self._concurrency_limit.release()
+        with self._in_flight_changed:
+            self._in_flight -= 1
+            self._in_flight_changed.notify_all()
+
+    def _drain(self):
+        with self._in_flight_changed:
+            self._in_flight_changed.wait_for(lambda: self._in_flight == 0)
+
+
+def _is_backoff_error(error):
+    return isinstance(error, BuildError) and error.service_failure
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Send documents for SNS style messages outside of Lambda.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='JSONL file of SNS messages, or - for stdin (default).')
+    parser.add_argument('--queue-url', help='Read SNS messages from this SQS queue instead of a file.')
+    parser.add_argument('--queue-region', help='Region of the SQS queue.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of processes rendering and building messages.')
+    parser.add_argument('--io-threads', type=int, default=16,
+                        help='Number of threads sending messages through SES.')
+    parser.add_argument('--max-in-flight', type=int,
+                        help='Maximum number of messages being built or sent at once.')
+    parser.add_argument('--adaptive-concurrency', type=int, metavar='INITIAL',
+                        help='Adapt the number of messages in flight to SES and S3 health, starting from INITIAL.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    max_in_flight = args.max_in_flight or args.processes * 2 + args.io_threads
+    circuit_breakers = load_circuit_breakers()
+    concurrency_limit = None
+    if args.adaptive_concurrency is not None:
+        concurrency_limit = AdaptiveConcurrencyLimit(initial_limit=args.adaptive_concurrency, max_limit=max_in_flight)
+        circuit_breakers.setdefault('ses', CircuitBreaker('ses'))
+    sender = DocSender(load_ses_client(), None, None, circuit_breakers=circuit_breakers,
+                       concurrency_limit=concurrency_limit)
+
+    with ProcessPoolExecutor(args.processes) as build_executor, \
+            ThreadPoolExecutor(args.io_threads) as send_executor:
+        worker = Worker(build_executor, send_executor, sender.send_raw_email, max_in_flight, concurrency_limit,
+                        load_memory_budget())
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+
+        if args.queue_url is not None:
+            sqs = boto3.session.Session(region_name=args.queue_region).client('sqs')
+            stats = worker.run(read_sqs_messages(sqs, args.queue_url, worker.stop_event))
+        elif args.input == '-':
+            stats = worker.run(read_jsonl_messages(sys.stdin))
+        else:
+            with open(args.input) as input_file:
+                stats = worker.run(read_jsonl_messages(input_file))
+
+    print(stats.format())
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
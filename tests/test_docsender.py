@@ -1,13 +1,23 @@
+from botocore.exceptions import ClientError
+from email import message_from_bytes, policy as email_policy
+from io import BytesIO
 from jwcrypto import jwe, jwk
-from jwcrypto.common import json_decode
-from ocoen.docsender import DocSender
+from jwcrypto.common import base64url_decode, json_decode, json_encode
+from ocoen.docsender import DocSender, RenderLimits, TemplateLimitError
+from ocoen.docsenderadmission import AdaptiveConcurrencyLimit, MemoryBudget, estimate_send_bytes
+from ocoen.docsenderbreakers import CircuitBreaker, CircuitOpenError
+from ocoen.docsendertracing import InMemorySpanExporter, Tracer
 from unittest.mock import create_autospec
 from yaml.error import YAMLError
 
+import gzip
+import hashlib
 import jinja2
 import ocoen.docsender
 import pytest
+import random
 import yaml
+import zipfile
 
 
 token_key = jwk.JWK.generate(kty='oct', size=256, kid='the key id')
@@ -228,6 +238,26 @@ def test_load_attachment(docsender, s3_buckets):
     assert ['text', 'plain'] == content_type
 
 
+def test_load_attachment_reads_into_buffer_of_content_length(docsender, mocker):
+    data = b'a,b,c\n1,2,3\n' * 1000
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+
+    attachment, content_type = docsender._load_attachment('results/report.csv')
+
+    assert isinstance(attachment, bytearray)
+    assert attachment == data
+
+
+def test_load_attachment_fails_on_truncated_body(docsender, mocker):
+    attachment_object = _attachment_object(mocker, b'a,b,c\n', 'text/csv')
+    attachment_object.get.side_effect = lambda: {'Body': BytesIO(b'a,b'), 'ContentType': 'text/csv',
+                                                 'ContentLength': 6}
+    docsender._attachment_bucket.Object.side_effect = lambda key: attachment_object
+
+    with pytest.raises(OSError):
+        docsender._load_attachment('results/report.csv')
+
+
 def test_create_tracking_token(docsender):
     event = {'event_data': 'id'}
     profile_key = 'profile_key'
@@ -253,6 +283,51 @@ def test_create_tracking_token(docsender):
     assert parsed_token['event'] == event
 
 
+def test_create_tracking_token_matches_jwcrypto_compact_format(docsender):
+    token = docsender._create_tracking_token(profile_key='profile_key')
+
+    protected, encrypted_key, iv, ciphertext, tag = token.split('.')
+    assert json_decode(base64url_decode(protected)) == {
+        'alg': 'dir',
+        'enc': 'A256GCM',
+        'kid': token_key.key_id,
+        'zip': 'DEF',
+    }
+    assert encrypted_key == ''
+    assert len(base64url_decode(iv)) == 96 // 8
+    assert len(base64url_decode(tag)) == 128 // 8
+
+    reference = jwe.JWE(
+        protected=json_decode(base64url_decode(protected)),
+        plaintext=json_encode({'profile_key': 'profile_key'}),
+        recipient=token_key,
+    ).serialize(compact=True)
+    assert reference.split('.')[0] == protected
+
+
+def test_create_tracking_token_uses_new_iv_each_time(docsender):
+    token1 = docsender._create_tracking_token(profile_key='profile_key')
+    token2 = docsender._create_tracking_token(profile_key='profile_key')
+
+    assert token1.split('.')[2] != token2.split('.')[2]
+
+
+def test_tracking_token_encoder_caches_cipher_per_key():
+    encoder = ocoen.docsender._TrackingTokenEncoder(max_keys=1)
+    other_key = jwk.JWK.generate(kty='oct', size=256, kid='other key id')
+
+    cipher1 = encoder._cipher(token_key)
+    cipher2 = encoder._cipher(token_key)
+    encoder._cipher(other_key)
+    cipher3 = encoder._cipher(token_key)
+
+    assert cipher1 is cipher2
+    assert cipher1 is not cipher3
+    decrypted_token = jwe.JWE()
+    decrypted_token.deserialize(encoder.encode(other_key, {'a': 'b'}), other_key)
+    assert json_decode(decrypted_token.payload) == {'a': 'b'}
+
+
 def test_create_tracking_token_no_key_function(docsender, mocker):
     mocker.patch.object(docsender, '_token_key_provider', None)
     event = {'event_data': 'id'}
@@ -321,3 +396,670 @@ def test_send_email(docsender, mocker):
         tracking_token=tracking_token,
     )
     docsender._ses.send_raw_email.assert_called_once_with(RawMessage={'Data': mime_message})
+
+
+def test_send_email_returns_stage_metrics(docsender, mocker):
+    profile = {
+        'from': 'from',
+        'to': 'to',
+        'body_text_template': 'body',
+    }
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=profile)
+    mocker.patch('ocoen.docsender.DocSender._load_attachment', autospec=True,
+                 return_value=(b'test data', ['text', 'plain']))
+
+    metrics = docsender.send_email('profile_key', 'attachment_key', {})
+
+    assert list(metrics) == [
+        'load_profile',
+        'load_attachment',
+        'create_tracking_token',
+        'format_message',
+        'create_mime_message',
+        'email_size',
+        'attachment_size',
+        'send_raw_email',
+    ]
+    assert metrics['attachment_size'] == len(b'test data')
+    assert metrics['email_size'] == len(docsender._ses.send_raw_email.call_args[1]['RawMessage']['Data'])
+
+
+def _attachment_object(mocker, data, content_type):
+    attachment_object = mocker.MagicMock()
+    attachment_object.get.side_effect = lambda: {
+        'Body': BytesIO(data),
+        'ContentType': content_type,
+        'ContentLength': len(data),
+    }
+    return attachment_object
+
+
+def test_load_compressed_attachment_gzip(docsender, mocker):
+    data = b'a,b,c\n1,2,3\n' * 10000
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+    mocker.patch.object(DocSender, 'ATTACHMENT_CHUNK_SIZE', 1000)
+    metrics = {}
+
+    attachment, content_type, suffix = docsender._load_compressed_attachment(
+        'results/report.csv', {'format': 'gzip'}, metrics)
+
+    assert gzip.decompress(attachment) == data
+    assert content_type == ['application', 'gzip']
+    assert suffix == '.gz'
+    assert metrics['attachment_uncompressed_size'] == len(data)
+    assert metrics['attachment_compression_ratio'] == len(data) / len(attachment)
+
+
+def test_load_compressed_attachment_zip(docsender, mocker):
+    data = b'<report>' + b'<row>1</row>' * 10000 + b'</report>'
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(
+        mocker, data, 'application/xml; charset=utf-8')
+
+    attachment, content_type, suffix = docsender._load_compressed_attachment(
+        'results/report.xml', {'format': 'zip'}, {})
+
+    with zipfile.ZipFile(BytesIO(attachment)) as attachment_zip:
+        assert attachment_zip.namelist() == ['report.xml']
+        assert attachment_zip.read('report.xml') == data
+    assert content_type == ['application', 'zip']
+    assert suffix == '.zip'
+
+
+def test_load_compressed_attachment_below_min_size(docsender, mocker):
+    data = b'a,b,c\n'
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+    metrics = {}
+
+    attachment, content_type, suffix = docsender._load_compressed_attachment(
+        'results/report.csv', {'min_size': 1024}, metrics)
+
+    assert attachment == data
+    assert content_type == ['text', 'csv']
+    assert suffix == ''
+    assert metrics == {}
+
+
+def test_load_compressed_attachment_unmatched_content_type(docsender, mocker):
+    data = b'%PDF' * 1000
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(
+        mocker, data, 'application/pdf')
+
+    attachment, content_type, suffix = docsender._load_compressed_attachment(
+        'results/report.pdf', {'content_types': ['text/*']}, {})
+
+    assert attachment == data
+    assert content_type == ['application', 'pdf']
+
+
+def test_load_compressed_attachment_unknown_format(docsender, mocker):
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, b'data', 'text/csv')
+
+    with pytest.raises(ValueError):
+        docsender._load_compressed_attachment('results/report.csv', {'format': 'rar'}, {})
+
+
+def test_send_email_compresses_attachment(docsender, mocker):
+    data = b'a,b,c\n1,2,3\n' * 1000
+    profile = {
+        'from': 'from',
+        'to': 'to',
+        'attachment_name_template': 'report.csv',
+        'body_text_template': 'body',
+        'attachment_compression': {'format': 'gzip'},
+    }
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+
+    metrics = docsender.send_email('profile_key', 'results/report.csv', {})
+
+    email = message_from_bytes(docsender._ses.send_raw_email.call_args[1]['RawMessage']['Data'])
+    attachment_part = email.get_payload()[1]
+    assert attachment_part.get_filename() == 'report.csv.gz'
+    assert attachment_part.get_content_type() == 'application/gzip'
+    assert gzip.decompress(attachment_part.get_payload(decode=True)) == data
+    assert metrics['attachment_compression_ratio'] > 1
+
+
+def test_send_email_reserves_memory_until_sent(docsender, mocker):
+    data = b'a,b,c\n1,2,3\n' * 1000
+    profile = {
+        'from': 'from',
+        'to': 'to',
+        'body_text_template': 'body',
+    }
+    budget = MemoryBudget(10 * 2 ** 20)
+    mocker.patch.object(docsender, '_memory_budget', budget)
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+    in_flight_while_sending = []
+    docsender._ses.send_raw_email.side_effect = lambda **kwargs: in_flight_while_sending.append(budget.in_flight_bytes)
+
+    docsender.send_email('profile_key', 'results/report.csv', {})
+
+    assert in_flight_while_sending == [estimate_send_bytes(len(data))]
+    assert budget.in_flight_bytes == 0
+
+
+def test_send_email_releases_memory_on_failure(docsender, mocker):
+    budget = MemoryBudget(10 * 2 ** 20)
+    mocker.patch.object(docsender, '_memory_budget', budget)
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value={'from': 'from'})
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, b'data', 'text/csv')
+
+    with pytest.raises(KeyError):
+        docsender.send_email('profile_key', 'results/report.csv', {})
+
+    assert budget.in_flight_bytes == 0
+
+
+def test_load_attachment_outside_send_does_not_reserve_memory(docsender, mocker):
+    budget = MemoryBudget(10 * 2 ** 20)
+    mocker.patch.object(docsender, '_memory_budget', budget)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, b'data', 'text/csv')
+
+    docsender._load_attachment('results/report.csv')
+
+    assert budget.in_flight_bytes == 0
+
+
+def test_format_message_parts_loop_iteration_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 10000, 100))
+    profile = {
+        'body_text_template': '{% for i in range(50) %}{% for j in range(50) %}{% endfor %}{% endfor %}',
+    }
+
+    with pytest.raises(TemplateLimitError) as e:
+        docsender._format_message_parts(profile, {})
+
+    assert e.value.limit == 'max_loop_iterations'
+
+
+def _tree(depth):
+    return {'name': str(depth), 'children': [_tree(depth - 1), _tree(depth - 1)] if depth else []}
+
+
+def test_format_message_parts_recursive_loop_iteration_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 10000, 10))
+    profile = {
+        'body_text_template': '{% for node in event.tree recursive %}{{ node.name }}{{ loop(node.children) }}'
+                              '{% endfor %}',
+    }
+
+    with pytest.raises(TemplateLimitError) as e:
+        docsender._format_message_parts(profile, {'tree': [_tree(4)]})
+
+    assert e.value.limit == 'max_loop_iterations'
+
+
+def test_format_message_parts_recursive_loops_within_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 10000, 7))
+    profile = {
+        'body_text_template': '{% for node in event.tree recursive %}{{ node.name }}'
+                              '{% for child in node.children %}{% endfor %}{{ loop(node.children) }}{% endfor %}',
+    }
+
+    message_parts = docsender._format_message_parts(profile, {'tree': [_tree(1)]})
+
+    assert message_parts['body']['text'] == '100'
+
+
+def test_format_message_parts_loops_within_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 10000, 100))
+    profile = {
+        'body_text_template': '{% for name in event.names %}{{ loop.index }}{{ name }}{% if loop.last %}.{% endif %}'
+                              '{% endfor %}',
+    }
+
+    message_parts = docsender._format_message_parts(profile, {'names': ['a', 'b']})
+
+    assert message_parts['body']['text'] == '1a2b.'
+
+
+def test_format_message_parts_output_size_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 100, 1000))
+    profile = {
+        'body_text_template': '{% for i in range(20) %}0123456789{% endfor %}',
+    }
+
+    with pytest.raises(TemplateLimitError) as e:
+        docsender._format_message_parts(profile, {})
+
+    assert e.value.limit == 'max_output_size'
+
+
+def test_format_message_parts_string_repetition_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 100, 1000))
+    profile = {
+        'subject_template': '{% set big = "x" * 1000000000 %}{{ big | length }}',
+    }
+
+    with pytest.raises(TemplateLimitError) as e:
+        docsender._format_message_parts(profile, {})
+
+    assert e.value.limit == 'max_output_size'
+
+
+def test_format_message_parts_time_limit(docsender, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(0.05, 10000, 10 ** 9))
+    profile = {
+        'body_text_template': '{% for i in range(100000) %}{% for j in range(100000) %}{% endfor %}{% endfor %}',
+    }
+
+    with pytest.raises(TemplateLimitError) as e:
+        docsender._format_message_parts(profile, {})
+
+    assert e.value.limit == 'max_seconds'
+
+
+def test_send_email_records_render_limit_metric(docsender, mocker):
+    exporter = InMemorySpanExporter()
+    mocker.patch.object(docsender, '_tracer', Tracer([exporter]))
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 10000, 10))
+    profile = {
+        'from': 'from',
+        'to': 'to',
+        'body_text_template': '{% for i in range(50) %}{% endfor %}',
+    }
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=profile)
+    mocker.patch('ocoen.docsender.DocSender._load_attachment', autospec=True,
+                 return_value=(b'test data', ['text', 'plain']))
+    log_metrics = mocker.patch('ocoen.docsender._log_metrics')
+
+    with pytest.raises(TemplateLimitError):
+        docsender.send_email('profile_key', 'attachment_key', {})
+
+    send_email_span = [span for span in exporter.spans if span.name == 'send_email'][0]
+    assert send_email_span.attributes['render_limit_exceeded'] == 'max_loop_iterations'
+    metrics = log_metrics.call_args[0][0]
+    assert metrics['render_limit_exceeded'] == 'max_loop_iterations'
+    assert 'format_message' in metrics
+
+
+def test_send_email_profiles_with_profile_key(docsender, mocker):
+    profiler = mocker.MagicMock()
+    mocker.patch.object(docsender, '_profiler', profiler)
+    mocker.patch('ocoen.docsender.DocSender._build_email', autospec=True, return_value=(b'email', {}))
+
+    docsender.send_email('profile_key', 'attachment_key', {})
+
+    profiler.profile.assert_called_once_with('profile_key')
+    assert profiler.profile.return_value.__enter__.call_count == 1
+
+
+def test_send_email_creates_span_per_stage(docsender, mocker):
+    exporter = InMemorySpanExporter()
+    mocker.patch.object(docsender, '_tracer', Tracer([exporter]))
+    profile = {
+        'from': 'from',
+        'to': 'to',
+        'body_text_template': 'body',
+    }
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=profile)
+    mocker.patch('ocoen.docsender.DocSender._load_attachment', autospec=True,
+                 return_value=(b'test data', ['text', 'plain']))
+
+    docsender.send_email('profile_key', 'attachment_key', {})
+
+    spans = {span.name: span for span in exporter.spans}
+    assert set(spans) == set(DocSender.STAGES + ['send_email'])
+    root = spans['send_email']
+    assert root.parent_id is None
+    assert all(span.parent_id == root.span_id for name, span in spans.items() if name != 'send_email')
+    assert root.attributes['profile_key'] == 'profile_key'
+    assert root.attributes['attachment_size'] == len(b'test data')
+    assert root.attributes['email_size'] > 0
+
+
+def _trusted_profile(docsender, s3_buckets, profile):
+    profile_data = yaml.dump({'email': profile}).encode('utf-8')
+    s3_buckets.object_data['profile']['trusted.yaml'] = profile_data
+    docsender._trusted_profile_hashes = frozenset([hashlib.sha256(profile_data).hexdigest()])
+    return docsender._load_profile('trusted.yaml')
+
+
+def test_load_profile_trusted_by_hash(docsender, s3_buckets):
+    expected_profile = {'subject_template': 'test_subject'}
+
+    profile = _trusted_profile(docsender, s3_buckets, expected_profile)
+
+    assert isinstance(profile, ocoen.docsender._TrustedProfile)
+    assert profile == expected_profile
+    assert profile.digest in docsender._trusted_profile_hashes
+
+
+def test_load_profile_not_in_allowlist_is_untrusted(docsender, s3_buckets):
+    _trusted_profile(docsender, s3_buckets, {'subject_template': 'test_subject'})
+    s3_buckets.object_data['profile']['other.yaml'] = yaml.dump({'email': {'subject_template': 'changed'}})
+
+    profile = docsender._load_profile('other.yaml')
+
+    assert not isinstance(profile, ocoen.docsender._TrustedProfile)
+
+
+def test_format_message_parts_trusted_profile_is_not_sandboxed(docsender, s3_buckets):
+    profile = _trusted_profile(docsender, s3_buckets, {
+        'subject_template': '{{ event.__class__.__name__ }}',
+        'body_html_template': '<p>{{ event.name }}</p>',
+    })
+
+    message_parts = docsender._format_message_parts(profile, {'name': '<bob>'})
+
+    assert message_parts['subject'] == 'dict'
+    assert message_parts['body']['html'] == '<p>&lt;bob&gt;</p>'
+    with pytest.raises(jinja2.exceptions.SecurityError):
+        docsender._format_message_parts(dict(profile), {'name': '<bob>'})
+
+
+def test_format_message_parts_trusted_environment_is_cached(docsender, s3_buckets):
+    profile = _trusted_profile(docsender, s3_buckets, {'subject_template': 'subject {{ event.name }}'})
+
+    environment1 = docsender._environment(profile, docsender._build_templates_dict(profile)[0])
+    environment2 = docsender._environment(profile, docsender._build_templates_dict(profile)[0])
+
+    assert environment1 is environment2
+    assert docsender._format_message_parts(profile, {'name': 'bob'})['subject'] == 'subject bob'
+
+
+def test_format_message_parts_trusted_profile_keeps_render_limits(docsender, s3_buckets, mocker):
+    mocker.patch.object(docsender, '_render_limits', RenderLimits(10, 10000, 10))
+    profile = _trusted_profile(docsender, s3_buckets, {
+        'body_text_template': '{% for i in range(50) %}{% endfor %}',
+    })
+
+    with pytest.raises(TemplateLimitError):
+        docsender._format_message_parts(profile, {})
+
+
+def _warm_up_bucket(mocker, profiles):
+    def profile_object(key):
+        profile_object = mocker.MagicMock()
+
+        def get(**kwargs):
+            if key not in profiles:
+                raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+            etag, profile = profiles[key]
+            if kwargs.get('IfNoneMatch') == etag:
+                raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+            return {'Body': BytesIO(yaml.dump({'email': profile}).encode('utf-8')), 'ETag': etag}
+        profile_object.get.side_effect = get
+        return profile_object
+    bucket = mocker.MagicMock()
+    bucket.Object.side_effect = profile_object
+    return bucket
+
+
+def test_warm_up_caches_profiles_revalidated_by_etag(docsender, mocker):
+    profiles = {'a.yaml': ('"1"', {'subject_template': 'a'}), 'b.yaml': ('"2"', {'subject_template': 'b'})}
+    mocker.patch.object(docsender, '_profile_bucket', _warm_up_bucket(mocker, profiles))
+    parse_profile = mocker.spy(docsender, '_parse_profile')
+
+    assert docsender.warm_up(['a.yaml', 'b.yaml', 'missing.yaml']) == 2
+    assert parse_profile.call_count == 2
+
+    assert docsender._load_profile('a.yaml') == {'subject_template': 'a'}
+    assert parse_profile.call_count == 2
+
+    profiles['a.yaml'] = ('"3"', {'subject_template': 'changed'})
+    assert docsender._load_profile('a.yaml') == {'subject_template': 'changed'}
+    assert docsender._load_profile('a.yaml') == {'subject_template': 'changed'}
+    assert parse_profile.call_count == 3
+
+
+def test_warm_up_pre_generates_token_key(docsender, mocker):
+    mocker.patch.object(docsender, '_profile_bucket', _warm_up_bucket(mocker, {}))
+
+    docsender.warm_up([])
+
+    docsender._token_key_provider.assert_called_once_with()
+
+
+def test_warm_up_compiles_trusted_profile_templates(docsender, mocker):
+    profile = {'subject_template': 'subject {{ event.name }}'}
+    profile_data = yaml.dump({'email': profile}).encode('utf-8')
+    mocker.patch.object(docsender, '_trusted_profile_hashes', {hashlib.sha256(profile_data).hexdigest()})
+    mocker.patch.object(docsender, '_profile_bucket', _warm_up_bucket(mocker, {'a.yaml': ('"1"', profile)}))
+
+    docsender.warm_up(['a.yaml'])
+
+    assert len(docsender._trusted_environments) == 1
+
+
+def test_warm_up_logs_template_errors(docsender, mocker):
+    profiles = {'a.yaml': ('"1"', {'subject_template': '{% if %}'})}
+    mocker.patch.object(docsender, '_profile_bucket', _warm_up_bucket(mocker, profiles))
+
+    assert docsender.warm_up(['a.yaml']) == 0
+    assert docsender._warm_profiles == {}
+
+
+recipient_profile = {
+    'from': 'from@example.com',
+    'to': 'ignored@example.com',
+    'subject_template': 'Report {{ event.period }} for {{ recipient.name }}',
+    'attachment_name_template': 'report-{{ event.period }}.csv',
+    'body_text_template': 'Hi {{ recipient.name }}',
+}
+
+
+def _sent_emails(docsender):
+    return [
+        message_from_bytes(call[1]['RawMessage']['Data'], policy=email_policy.default)
+        for call in docsender._ses.send_raw_email.call_args_list
+    ]
+
+
+def test_send_email_to_recipients_in_event(docsender, mocker):
+    data = b'a,b\n1,2\n'
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+    environment = mocker.spy(docsender, '_environment')
+    create_attachment_part = mocker.spy(ocoen.docsender, '_create_attachment_part')
+    encode_base64 = mocker.spy(ocoen.docsender, '_encode_base64')
+    event = {
+        'period': '2017-10',
+        'recipients': [{'to': 'bob@example.com', 'name': 'Bob'}, {'to': 'amy@example.com', 'name': 'Amy'}],
+    }
+
+    metrics = docsender.send_email('profile_key', 'results/report.csv', event)
+
+    emails = _sent_emails(docsender)
+    assert [email['To'] for email in emails] == ['bob@example.com', 'amy@example.com']
+    assert [email['Subject'] for email in emails] == ['Report 2017-10 for Bob', 'Report 2017-10 for Amy']
+    assert all(email.get_payload()[1].get_payload(decode=True) == data for email in emails)
+    assert all(email.get_payload()[1].get_filename() == 'report-2017-10.csv' for email in emails)
+    docsender._attachment_bucket.Object.assert_called_once_with('results/report.csv')
+    assert environment.call_count == 1
+    assert create_attachment_part.call_count == 1
+    assert encode_base64.call_count == 1
+    assert metrics['recipients'] == 2
+    assert metrics['recipients_failed'] == 0
+    assert metrics['email_size'] == sum(len(call[1]['RawMessage']['Data'])
+                                        for call in docsender._ses.send_raw_email.call_args_list)
+
+    token = jwe.JWE()
+    token.deserialize(emails[1]['x-ocoen-tracking-token'], token_key)
+    claims = json_decode(token.payload)
+    assert claims['recipient'] == {'to': 'amy@example.com', 'name': 'Amy'}
+    assert claims['event'] == {'period': '2017-10'}
+
+
+def test_send_email_to_recipients_encodes_attachment_once_per_event(docsender, mocker):
+    data = b'a,b\n1,2\n'
+    profile = dict(recipient_profile, attachment_name_template='report-{{ recipient.name }}.csv')
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, data, 'text/csv')
+    encode_base64 = mocker.spy(ocoen.docsender, '_encode_base64')
+    event = {
+        'period': '2017-10',
+        'recipients': [{'to': 'bob@example.com', 'name': 'Bob'}, {'to': 'amy@example.com', 'name': 'Amy'}],
+    }
+
+    docsender.send_email('profile_key', 'results/report.csv', event)
+
+    emails = _sent_emails(docsender)
+    assert [email.get_payload()[1].get_filename() for email in emails] == ['report-Bob.csv', 'report-Amy.csv']
+    assert all(email.get_payload()[1].get_payload(decode=True) == data for email in emails)
+    assert encode_base64.call_count == 1
+
+
+def test_send_email_to_recipients_csv_in_s3(docsender, mocker):
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+    objects = {
+        'results/report.csv': (b'a,b\n', 'text/csv'),
+        'results/recipients.csv': (b'\xef\xbb\xbfto,name\nbob@example.com,Bob\namy@example.com,Amy\n', 'text/csv'),
+    }
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, *objects[key])
+
+    docsender.send_email('profile_key', 'results/report.csv', {'period': '2017-10',
+                                                               'recipients_key': 'results/recipients.csv'})
+
+    assert [email['Subject'] for email in _sent_emails(docsender)] == [
+        'Report 2017-10 for Bob', 'Report 2017-10 for Amy']
+
+
+def test_send_email_to_recipients_json_in_s3(docsender, mocker):
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+    objects = {
+        'results/report.csv': (b'a,b\n', 'text/csv'),
+        'results/recipients.json': (json_encode([{'to': 'bob@example.com', 'name': 'Bob'}]).encode('utf-8'),
+                                    'application/json'),
+    }
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, *objects[key])
+
+    docsender.send_email('profile_key', 'results/report.csv', {'period': '2017-10',
+                                                               'recipients_key': 'results/recipients.json'})
+
+    assert [email['To'] for email in _sent_emails(docsender)] == ['bob@example.com']
+
+
+def test_send_email_to_recipients_continues_after_failure(docsender, mocker):
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, b'a,b\n', 'text/csv')
+    docsender._ses.send_raw_email.side_effect = [ValueError('rejected'), None]
+    event = {
+        'period': '2017-10',
+        'recipients': [{'to': 'bad', 'name': 'Bad'}, {'to': 'amy@example.com', 'name': 'Amy'}],
+    }
+
+    metrics = docsender.send_email('profile_key', 'results/report.csv', event)
+
+    assert metrics['recipients_failed'] == 1
+    assert docsender._ses.send_raw_email.call_count == 2
+
+
+def test_send_email_to_recipients_raises_when_all_fail(docsender, mocker):
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, b'a,b\n', 'text/csv')
+    docsender._ses.send_raw_email.side_effect = ValueError('rejected')
+
+    with pytest.raises(ValueError):
+        docsender.send_email('profile_key', 'results/report.csv', {
+            'period': '2017-10',
+            'recipients': [{'to': 'bad', 'name': 'Bad'}],
+        })
+
+
+def test_send_email_to_recipients_requires_to(docsender, mocker):
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+
+    with pytest.raises(ValueError):
+        docsender.send_email('profile_key', 'results/report.csv', {'recipients': [{'name': 'Bob'}]})
+
+
+def test_send_email_to_recipients_within_concurrency_limit(docsender, mocker):
+    mocker.patch('ocoen.docsender.DocSender._load_profile', autospec=True, return_value=recipient_profile)
+    docsender._attachment_bucket.Object.side_effect = lambda key: _attachment_object(mocker, b'a,b\n', 'text/csv')
+    limit = AdaptiveConcurrencyLimit(initial_limit=2, max_limit=4)
+    docsender._concurrency_limit = limit
+    in_flight_while_sending = []
+    docsender._ses.send_raw_email.side_effect = lambda **kwargs: in_flight_while_sending.append(limit.in_flight)
+    event = {
+        'period': '2017-10',
+        'recipients': [{'to': 'user{}@example.com'.format(i), 'name': str(i)} for i in range(10)],
+    }
+
+    metrics = docsender.send_email('profile_key', 'results/report.csv', event)
+
+    assert sorted(email['To'] for email in _sent_emails(docsender)) == sorted(
+        recipient['to'] for recipient in event['recipients'])
+    assert max(in_flight_while_sending) <= 2
+    assert limit.in_flight == 0
+    assert metrics['recipients_failed'] == 0
+
+
+def test_send_email_fails_fast_when_ses_circuit_is_open(session, s3_buckets, mocker):
+    ses = create_autospec(session.client('ses').__class__, instance=True)
+    ses.send_raw_email.side_effect = ConnectionError('timed out')
+    limit = AdaptiveConcurrencyLimit(initial_limit=8)
+    docsender = DocSender(ses, s3_buckets.Bucket('profile'), s3_buckets.Bucket('attachment'),
+                          circuit_breakers={'ses': CircuitBreaker('ses', failure_threshold=1)},
+                          concurrency_limit=limit)
+
+    with pytest.raises(ConnectionError):
+        docsender.send_raw_email(b'email')
+    with pytest.raises(CircuitOpenError):
+        docsender.send_raw_email(b'email')
+
+    assert ses.send_raw_email.call_count == 1
+    assert limit.limit == 4
+
+
+def test_load_attachment_counts_failed_body_reads_as_s3_failures(docsender, mocker):
+    breaker = CircuitBreaker('s3', failure_threshold=1)
+    mocker.patch.object(docsender, '_circuit_breakers', {'s3': breaker})
+    body = mocker.MagicMock()
+    body.readinto.side_effect = ConnectionResetError('reset')
+    attachment_object = mocker.MagicMock()
+    attachment_object.get.return_value = {'Body': body, 'ContentType': 'text/csv', 'ContentLength': 100}
+    docsender._attachment_bucket.Object.side_effect = lambda key: attachment_object
+
+    with pytest.raises(ConnectionResetError):
+        docsender._load_attachment('results/report.csv')
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_load_compressed_attachment_counts_slow_chunk_reads_as_s3_failures(docsender, mocker):
+    now = [0.0]
+    breaker = CircuitBreaker('s3', failure_threshold=1, slow_call_seconds=2, clock=lambda: now[0])
+    mocker.patch.object(docsender, '_circuit_breakers', {'s3': breaker})
+    mocker.patch.object(DocSender, 'ATTACHMENT_CHUNK_SIZE', 1000)
+    data = BytesIO(b'a,b,c\n1,2,3\n' * 10000)
+
+    def slow_read(size):
+        now[0] += 3
+        return data.read(size)
+
+    body = mocker.MagicMock()
+    body.read.side_effect = slow_read
+    attachment_object = mocker.MagicMock()
+    attachment_object.get.return_value = {
+        'Body': body, 'ContentType': 'text/csv', 'ContentLength': len(data.getvalue())}
+    docsender._attachment_bucket.Object.side_effect = lambda key: attachment_object
+
+    with pytest.raises(CircuitOpenError):
+        docsender._load_compressed_attachment('results/report.csv', {'format': 'gzip'}, {})
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert body.read.call_count == 1
+
+
+def test_build_email_rejects_recipients(docsender):
+    with pytest.raises(ValueError):
+        docsender.build_email('profile_key', 'results/report.csv', {'recipients': [{'to': 'bob@example.com'}]})
+
+
+def test_shared_attachment_part_matches_create_mime_message():
+    attachment = {'name': 'report.csv', 'data': b'a,b\n1,2\n' * 1000, 'type': ['text', 'csv']}
+    attachment_part = ocoen.docsender._create_attachment_part(attachment)
+    encoded_attachment = ocoen.docsender._encode_base64(attachment['data'])
+    kwargs = {'from_': 'from', 'to': 'to', 'subject': 'subject', 'message_formats': {'text': 'body'}}
+
+    random.seed(1)
+    shared = ocoen.docsender._write_mime_message(
+        ocoen.docsender._assemble_mime_message(attachment_part=attachment_part.placeholder, **kwargs),
+        attachment_part.token_line, encoded_attachment, encoded=True)
+    random.seed(1)
+    expected = ocoen.docsender._create_mime_message(attachment=attachment, **kwargs)
+
+    assert shared == expected
@@ -1,8 +1,12 @@
 from base64 import b64decode
 from email import message_from_bytes
 from email.message import EmailMessage
+from email.policy import SMTPUTF8
 from ocoen.docsender import _create_mime_message
+
+import base64
 import pytest
+import random
 
 
 example_message = {
@@ -122,3 +126,33 @@ def test_create_mime_message_with_no_tracking_token():
     email = message_from_bytes(result, _class=EmailMessage)
 
     assert 'x-ocoen-tracking-token' not in email
+
+
+def _email_package_mime_message(message_parts, attachment):
+    email = EmailMessage(policy=SMTPUTF8)
+    email.set_content(message_parts['text'])
+    email.make_mixed()
+    email['From'] = 'test@example.com'
+    email['To'] = 'to@example.com'
+    email['Subject'] = 'subject'
+    attachment_part = EmailMessage(policy=SMTPUTF8)
+    attachment_part.set_content(attachment['data'], filename=attachment['name'],
+                                maintype=attachment['type'][0], subtype=attachment['type'][1])
+    email.attach(attachment_part)
+    return email.as_bytes()
+
+
+@pytest.mark.parametrize('size', [0, 1, 56, 57, 58, 57 * 3, 57 * 3 + 1, 10000])
+def test_create_mime_message_attachment_matches_email_package(mocker, size):
+    mocker.patch('ocoen.docsender._BASE64_BLOCK_SIZE', base64.MAXBINSIZE * 3)
+    message_parts = {'text': 'text message'}
+    attachment = {'name': 'r\u00e9sum\u00e9.pdf', 'data': bytes(range(256)) * (size // 256) + bytes(size % 256),
+                  'type': ['application', 'pdf']}
+
+    random.seed(size)
+    result = _create_mime_message('test@example.com', 'to@example.com', 'subject', message_parts, attachment)
+    random.seed(size)
+    expected = _email_package_mime_message(message_parts, attachment)
+
+    assert isinstance(result, bytearray)
+    assert result == expected
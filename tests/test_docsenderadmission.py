@@ -0,0 +1,223 @@
+from ocoen.docsenderadmission import AdaptiveConcurrencyLimit, MemoryBudget, NO_MEMORY_BUDGET, \
+    SEND_MEMORY_MULTIPLIER, SEND_MEMORY_OVERHEAD, available_memory, estimate_send_bytes, load_concurrency_limit, \
+    load_memory_budget
+
+import asyncio
+import pytest
+import threading
+import time
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def _acquire_in_thread(budget, nbytes, admitted):
+    def acquire():
+        budget.acquire(nbytes)
+        admitted.append(nbytes)
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    time.sleep(0.05)
+    return thread
+
+
+def test_estimate_send_bytes():
+    assert estimate_send_bytes(100) == 100 * SEND_MEMORY_MULTIPLIER + SEND_MEMORY_OVERHEAD
+    assert estimate_send_bytes(None) == SEND_MEMORY_OVERHEAD
+
+
+def test_memory_budget_admits_within_budget():
+    budget = MemoryBudget(100)
+
+    with budget.reserve(60):
+        with budget.reserve(40):
+            assert budget.in_flight_bytes == 100
+
+    assert budget.in_flight_bytes == 0
+
+
+def test_memory_budget_queues_until_released():
+    budget = MemoryBudget(100)
+    admitted = []
+    budget.acquire(60)
+
+    thread = _acquire_in_thread(budget, 50, admitted)
+    assert admitted == []
+
+    budget.release(60)
+    thread.join()
+    assert admitted == [50]
+    assert budget.in_flight_bytes == 50
+
+
+def test_memory_budget_serialises_sends_larger_than_budget():
+    budget = MemoryBudget(100)
+    admitted = []
+    budget.acquire(10)
+
+    thread = _acquire_in_thread(budget, 500, admitted)
+    assert admitted == []
+
+    budget.release(10)
+    thread.join()
+    assert admitted == [500]
+
+
+def test_memory_budget_admits_in_arrival_order():
+    budget = MemoryBudget(100)
+    admitted = []
+    budget.acquire(60)
+    large = _acquire_in_thread(budget, 80, admitted)
+    small = _acquire_in_thread(budget, 10, admitted)
+
+    # The small send fits but waits behind the large send.
+    assert admitted == []
+    budget.release(60)
+    large.join()
+    small.join()
+    assert admitted == [80, 10]
+
+
+def test_memory_budget_acquire_async(loop):
+    budget = MemoryBudget(100)
+    admitted = []
+
+    async def send(nbytes):
+        await budget.acquire_async(nbytes)
+        admitted.append(nbytes)
+        await asyncio.sleep(0.01)
+        budget.release(nbytes)
+
+    async def send_all():
+        await asyncio.gather(send(60), send(60), send(30))
+
+    loop.run_until_complete(send_all())
+
+    assert admitted == [60, 60, 30]
+    assert budget.in_flight_bytes == 0
+
+
+def test_memory_budget_acquire_async_cancelled(loop):
+    budget = MemoryBudget(100)
+    budget.acquire(80)
+
+    async def cancel_waiter():
+        waiter = asyncio.ensure_future(budget.acquire_async(50))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    loop.run_until_complete(cancel_waiter())
+    budget.release(80)
+
+    assert budget.in_flight_bytes == 0
+
+
+def test_available_memory_uses_lambda_memory_size():
+    assert available_memory({'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '512'}) == 512 * 2 ** 20
+
+
+def test_available_memory_falls_back_to_host(mocker):
+    mocker.patch('ocoen.docsenderadmission._CGROUP_MEMORY_LIMITS', [])
+
+    assert available_memory({}) > 0
+
+
+def test_load_memory_budget_disabled_by_default():
+    assert load_memory_budget({}) is NO_MEMORY_BUDGET
+
+
+def test_load_memory_budget_uses_fraction_of_available_memory():
+    budget = load_memory_budget({'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '1024', 'MEMORY_BUDGET_FRACTION': '0.5'})
+
+    assert budget.max_bytes == 512 * 2 ** 20
+
+
+def test_adaptive_concurrency_limit_waits_for_slot():
+    limit = AdaptiveConcurrencyLimit(initial_limit=1)
+    limit.acquire()
+    admitted = []
+
+    thread = _acquire_in_thread(limit, 1, admitted)
+    assert admitted == []
+    limit.release()
+    thread.join()
+
+    assert admitted == [1]
+
+
+def test_adaptive_concurrency_limit_increases_additively():
+    limit = AdaptiveConcurrencyLimit(initial_limit=2, max_limit=3)
+
+    for _ in range(3):
+        limit.record_success()
+    assert limit.limit == 3
+    for _ in range(10):
+        limit.record_success()
+    assert limit.limit == 3
+
+
+def test_adaptive_concurrency_limit_decreases_multiplicatively():
+    clock = FakeClock()
+    limit = AdaptiveConcurrencyLimit(initial_limit=10, min_limit=2, decrease_seconds=1, clock=clock)
+
+    limit.record_failure()
+    assert limit.limit == 5
+    for _ in range(2):
+        clock.now += 1
+        limit.record_failure()
+    assert limit.limit == 2
+
+
+def test_adaptive_concurrency_limit_decreases_once_per_window():
+    clock = FakeClock()
+    limit = AdaptiveConcurrencyLimit(initial_limit=16, decrease_seconds=1, clock=clock)
+
+    for _ in range(10):
+        limit.record_failure()
+    assert limit.limit == 8
+    clock.now += 0.5
+    limit.record_failure()
+    assert limit.limit == 8
+    clock.now += 0.5
+    limit.record_failure()
+    assert limit.limit == 4
+
+
+def test_adaptive_concurrency_limit_admits_waiters_when_limit_grows():
+    limit = AdaptiveConcurrencyLimit(initial_limit=1)
+    limit.acquire()
+    admitted = []
+
+    thread = _acquire_in_thread(limit, 1, admitted)
+    limit.record_success()
+    thread.join()
+
+    assert admitted == [1]
+    assert limit.in_flight == 2
+
+
+def test_load_concurrency_limit():
+    assert load_concurrency_limit({}) is None
+    limit = load_concurrency_limit({
+        'ADAPTIVE_CONCURRENCY_MAX': '50',
+        'ADAPTIVE_CONCURRENCY_INITIAL': '5',
+        'ADAPTIVE_CONCURRENCY_DECREASE_SECONDS': '2.5',
+    })
+    assert limit.limit == 5
+    assert limit.max_limit == 50
+    assert limit._decrease_seconds == 2.5
@@ -0,0 +1,227 @@
+from email import message_from_bytes, policy
+from jwcrypto import jwe, jwk
+from jwcrypto.common import json_decode
+from ocoen.docsender import DocSender
+from ocoen.docsenderadmission import AdaptiveConcurrencyLimit, MemoryBudget, estimate_send_bytes
+from ocoen.docsenderbreakers import CircuitBreaker, CircuitOpenError
+from ocoen.docsenderasync import AsyncDocSender, AsyncTokenKeyProvider
+from ocoen.docsendertracing import InMemorySpanExporter, Tracer
+
+import asyncio
+import os
+import pytest
+import yaml
+
+
+profile = {
+    'from': 'from@example.com',
+    'to': 'to@example.com',
+    'subject_template': 'subject {{ event.name }}',
+    'attachment_name_template': 'report.csv',
+    'body_text_template': 'body {{ event.name }}',
+}
+
+
+class StubBody:
+
+    def __init__(self, data):
+        self._data = data
+
+    async def read(self):
+        await asyncio.sleep(0)
+        return self._data
+
+
+class StubS3:
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.objects = {}
+        self.put_objects = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_object(self, Bucket, Key):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        data, content_type = self.objects[(Bucket, Key)]
+        return {'Body': StubBody(data), 'ContentType': content_type, 'ContentLength': len(data)}
+
+    async def put_object(self, **kwargs):
+        self.put_objects.append(kwargs)
+
+
+class StubKms:
+
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_data_key(self, **kwargs):
+        self.calls += 1
+        return {'Plaintext': os.urandom(32), 'CiphertextBlob': b'encrypted'}
+
+
+class StubSes:
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_raw_email(self, RawMessage):
+        await asyncio.sleep(0)
+        self.messages.append(RawMessage['Data'])
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def s3():
+    s3 = StubS3()
+    s3.objects[('profiles', 'profile.yaml')] = (yaml.dump({'email': profile}).encode('utf-8'), 'text/yaml')
+    s3.objects[('results', 'result.csv')] = (b'a,b\n1,2\n', 'text/csv')
+    return s3
+
+
+def test_async_token_key_provider_reuses_key(loop, s3):
+    kms = StubKms()
+    provider = AsyncTokenKeyProvider(kms, 'kms key', s3, 'keys', 'keys/', 'STANDARD')
+
+    key1 = loop.run_until_complete(provider.get_key())
+    key2 = loop.run_until_complete(provider.get_key())
+
+    assert key1 == key2
+    assert kms.calls == 1
+    assert s3.put_objects[0]['Bucket'] == 'keys'
+    assert s3.put_objects[0]['Key'] == 'keys/docsender_tracking_token/' + key1.key_id
+
+
+def test_async_send_email(loop, s3):
+    token_key = jwk.JWK.generate(kty='oct', size=256, kid='the key id')
+
+    async def token_key_provider():
+        return token_key
+
+    ses = StubSes()
+    docsender = AsyncDocSender(ses, s3, 'profiles', 'results', token_key_provider)
+
+    metrics = loop.run_until_complete(docsender.send_email('profile.yaml', 'result.csv', {'name': 'bob'}))
+
+    email = message_from_bytes(ses.messages[0], policy=policy.default)
+    assert email['Subject'] == 'subject bob'
+    assert email.get_payload()[1].get_filename() == 'report.csv'
+    token = jwe.JWE()
+    token.deserialize(email['x-ocoen-tracking-token'], token_key)
+    assert json_decode(token.payload)['event'] == {'name': 'bob'}
+    assert metrics['email_size'] == len(ses.messages[0])
+    assert 'send_raw_email' in metrics
+
+
+def test_async_send_email_spans(loop, s3):
+    exporter = InMemorySpanExporter()
+    docsender = AsyncDocSender(StubSes(), s3, 'profiles', 'results', tracer=Tracer([exporter]))
+
+    loop.run_until_complete(docsender.send_email('profile.yaml', 'result.csv', {'name': 'bob'}))
+
+    spans = {span.name: span for span in exporter.spans}
+    assert set(spans) == set(DocSender.STAGES + ['send_email'])
+    root = spans['send_email']
+    assert all(span.parent_id == root.span_id for name, span in spans.items() if name != 'send_email')
+
+
+def test_async_send_many_keeps_sends_in_flight(loop, s3):
+    s3.latency = 0.1
+    ses = StubSes()
+    docsender = AsyncDocSender(ses, s3, 'profiles', 'results')
+    sends = [('profile.yaml', 'result.csv', {'name': str(i)}) for i in range(300)]
+
+    results = loop.run_until_complete(docsender.send_many(sends, max_in_flight=250))
+
+    assert len(ses.messages) == 300
+    # Profile and attachment are fetched concurrently for every send in flight.
+    assert s3.max_in_flight == 500
+    assert all(isinstance(result, dict) for result in results)
+
+
+def test_async_send_many_keeps_in_flight_bytes_within_memory_budget(loop, s3):
+    budget = MemoryBudget(estimate_send_bytes(8) * 3)
+    in_flight_while_sending = []
+
+    class BudgetSes(StubSes):
+        async def send_raw_email(self, RawMessage):
+            in_flight_while_sending.append(budget.in_flight_bytes)
+            await super().send_raw_email(RawMessage)
+
+    ses = BudgetSes()
+    docsender = AsyncDocSender(ses, s3, 'profiles', 'results', memory_budget=budget)
+    sends = [('profile.yaml', 'result.csv', {'name': str(i)}) for i in range(20)]
+
+    loop.run_until_complete(docsender.send_many(sends))
+
+    assert len(ses.messages) == 20
+    assert max(in_flight_while_sending) <= budget.max_bytes
+    assert budget.in_flight_bytes == 0
+
+
+def test_async_send_email_releases_memory_budget_when_profile_load_fails(loop, s3):
+    class FailingProfileS3(StubS3):
+        async def get_object(self, Bucket, Key):
+            if Bucket == 'profiles':
+                raise ConnectionError('reset')
+            return await super().get_object(Bucket, Key)
+
+    failing_s3 = FailingProfileS3(latency=0.01)
+    failing_s3.objects = s3.objects
+    budget = MemoryBudget(10 ** 9)
+    docsender = AsyncDocSender(StubSes(), failing_s3, 'profiles', 'results', memory_budget=budget)
+
+    with pytest.raises(ConnectionError):
+        loop.run_until_complete(docsender.send_email('profile.yaml', 'result.csv', {'name': 'bob'}))
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert budget.in_flight_bytes == 0
+
+
+def test_async_send_many_within_concurrency_limit(loop, s3):
+    s3.latency = 0.01
+    limit = AdaptiveConcurrencyLimit(initial_limit=3, max_limit=3)
+    ses = StubSes()
+    docsender = AsyncDocSender(ses, s3, 'profiles', 'results', concurrency_limit=limit)
+    sends = [('profile.yaml', 'result.csv', {'name': str(i)}) for i in range(20)]
+
+    loop.run_until_complete(docsender.send_many(sends))
+
+    assert len(ses.messages) == 20
+    # Profile and attachment are fetched concurrently for every send in flight.
+    assert s3.max_in_flight == 6
+    assert limit.in_flight == 0
+
+
+def test_async_send_email_fails_fast_when_s3_circuit_is_open(loop, s3):
+    breaker = CircuitBreaker('s3', failure_threshold=1)
+    ses = StubSes()
+    docsender = AsyncDocSender(ses, s3, 'profiles', 'results', circuit_breakers={'s3': breaker})
+
+    with pytest.raises(KeyError):
+        loop.run_until_complete(docsender.send_email('profile.yaml', 'missing.csv', {'name': 'bob'}))
+    with pytest.raises(CircuitOpenError):
+        loop.run_until_complete(docsender.send_email('profile.yaml', 'result.csv', {'name': 'bob'}))
+
+    assert ses.messages == []
+
+
+def test_async_send_many_returns_errors(loop, s3):
+    ses = StubSes()
+    docsender = AsyncDocSender(ses, s3, 'profiles', 'results')
+    sends = [('profile.yaml', 'result.csv', {'name': 'bob'}), ('profile.yaml', 'missing.csv', {'name': 'bob'})]
+
+    results = loop.run_until_complete(docsender.send_many(sends))
+
+    assert isinstance(results[0], dict)
+    assert isinstance(results[1], KeyError)
+    assert len(ses.messages) == 1
@@ -0,0 +1,169 @@
+from botocore.exceptions import ClientError
+from ocoen.docsenderadmission import AdaptiveConcurrencyLimit
+from ocoen.docsenderbreakers import CircuitBreaker, CircuitOpenError, is_service_failure, load_circuit_breakers
+
+import pickle
+import pytest
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _client_error(code, status):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'GetObject')
+
+
+def _fail(breaker, error=None):
+    with pytest.raises(Exception):
+        with breaker.guard():
+            raise error or ConnectionError('timed out')
+
+
+def test_is_service_failure():
+    assert is_service_failure(ConnectionError('timed out'))
+    assert is_service_failure(_client_error('SlowDown', 503))
+    assert is_service_failure(_client_error('Throttling', 400))
+    assert is_service_failure(_client_error('InternalError', 500))
+    assert not is_service_failure(_client_error('NoSuchKey', 404))
+    assert not is_service_failure(_client_error('MessageRejected', 400))
+    assert not is_service_failure(_client_error('304', 304))
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('s3', failure_threshold=2, clock=FakeClock())
+
+    _fail(breaker)
+    with breaker.guard():
+        pass
+    _fail(breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
+    _fail(breaker)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        with breaker.guard():
+            pytest.fail('Open circuits must not make calls')
+
+
+def test_circuit_breaker_ignores_client_errors():
+    breaker = CircuitBreaker('s3', failure_threshold=1, clock=FakeClock())
+
+    _fail(breaker, _client_error('NoSuchKey', 404))
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_counts_slow_calls_as_failures():
+    clock = FakeClock()
+    breaker = CircuitBreaker('ses', failure_threshold=1, slow_call_seconds=2, clock=clock)
+
+    with breaker.guard():
+        clock.now += 3
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_breaker_half_open_allows_one_trial_call():
+    clock = FakeClock()
+    breaker = CircuitBreaker('kms', failure_threshold=1, reset_seconds=10, clock=clock)
+    _fail(breaker)
+    clock.now += 10
+
+    with breaker.guard():
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            with breaker.guard():
+                pass
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_reopens_after_failed_trial_call():
+    clock = FakeClock()
+    breaker = CircuitBreaker('kms', failure_threshold=3, reset_seconds=10, clock=clock)
+    for _ in range(3):
+        _fail(breaker)
+    clock.now += 10
+
+    _fail(breaker)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as e:
+        with breaker.guard():
+            pass
+    assert e.value.retry_after == 10
+
+
+def test_circuit_breaker_ignores_calls_admitted_before_it_opened():
+    breaker = CircuitBreaker('ses', failure_threshold=1, clock=FakeClock())
+
+    with breaker.guard():
+        _fail(breaker)
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_breaker_stale_calls_do_not_end_the_trial_call():
+    clock = FakeClock()
+    breaker = CircuitBreaker('ses', failure_threshold=1, reset_seconds=10, clock=clock)
+    stale_call = breaker.guard()
+    stale_call.__enter__()
+    _fail(breaker)
+    clock.now += 10
+
+    with breaker.guard():
+        stale_call.__exit__(None, None, None)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            with breaker.guard():
+                pass
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_feeds_concurrency_limit():
+    limit = AdaptiveConcurrencyLimit(initial_limit=8, max_limit=16)
+    breaker = CircuitBreaker('ses', failure_threshold=1, clock=FakeClock())
+    breaker.add_listener(limit)
+
+    for _ in range(10):
+        with breaker.guard():
+            pass
+    assert limit.limit == 9
+
+    _fail(breaker)
+    assert limit.limit == 4
+    with pytest.raises(CircuitOpenError):
+        with breaker.guard():
+            pass
+    assert limit.limit == 4
+
+
+def test_circuit_open_error_pickles():
+    error = pickle.loads(pickle.dumps(CircuitOpenError('ses', 5.0)))
+
+    assert error.name == 'ses'
+    assert str(error) == 'Circuit ses is open, retry after 5.0s'
+
+
+def test_load_circuit_breakers_disabled_by_default():
+    assert load_circuit_breakers({}) == {}
+
+
+def test_load_circuit_breakers():
+    breakers = load_circuit_breakers({
+        'CIRCUIT_BREAKER_FAILURES': '3',
+        'CIRCUIT_BREAKER_SLOW_SECONDS': '1.5',
+        'CIRCUIT_BREAKER_RESET_SECONDS': '20',
+    })
+
+    assert sorted(breakers) == ['kms', 's3', 'ses']
+    assert breakers['ses']._failure_threshold == 3
+    assert breakers['ses']._slow_call_seconds == 1.5
+    assert breakers['ses']._reset_seconds == 20
@@ -0,0 +1,198 @@
+from botocore.exceptions import ClientError
+from io import BytesIO
+from jinja2 import TemplateNotFound
+from jinja2.sandbox import SecurityError
+from ocoen.docsender import DocSender, _LimitedSandboxedEnvironment
+from ocoen.docsenderbreakers import CircuitBreaker, CircuitOpenError
+from ocoen.docsenderfragments import FragmentStore, load_fragment_store
+
+import hashlib
+import pytest
+import yaml
+
+
+class StubObject:
+
+    def __init__(self, bucket, key):
+        self._bucket = bucket
+        self._key = key
+
+    def get(self, **kwargs):
+        self._bucket.gets.append((self._key, kwargs))
+        if self._key not in self._bucket.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        data = self._bucket.objects[self._key]
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        if kwargs.get('IfNoneMatch') == etag:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'Body': BytesIO(data), 'ETag': etag}
+
+
+class StubBucket:
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+
+    def Object(self, key):
+        return StubObject(self, key)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+header = b'<h1>{{ title }}</h1>'
+macros = b'{% macro cell(value) %}<td>{{ value }}</td>{% endmacro %}'
+
+
+@pytest.fixture
+def bucket():
+    return StubBucket({
+        'fragments/header.html': header,
+        'fragments/macros/table.html': macros,
+    })
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def store(bucket, clock):
+    return FragmentStore(bucket, 'fragments/', ttl_seconds=60, clock=clock)
+
+
+def _profile_data(profile):
+    return yaml.dump({'email': profile}).encode('utf-8')
+
+
+def _docsender(store, trusted=()):
+    return DocSender(None, None, None, fragments=store,
+                     trusted_profile_hashes=[hashlib.sha256(data).hexdigest() for data in trusted])
+
+
+def test_fragment_store_caches_until_ttl_then_revalidates(store, bucket, clock):
+    assert store.fragment('header.html').source == header.decode('utf-8')
+    store.fragment('header.html')
+    assert len(bucket.gets) == 1
+
+    clock.now = 61
+    store.fragment('header.html')
+    assert len(bucket.gets) == 2
+    assert 'IfNoneMatch' in bucket.gets[1][1]
+
+    bucket.objects['fragments/header.html'] = b'<h2>{{ title }}</h2>'
+    clock.now = 122
+    assert store.fragment('header.html').source == '<h2>{{ title }}</h2>'
+
+
+def test_fragment_store_missing_fragment(store):
+    with pytest.raises(TemplateNotFound):
+        store.fragment('missing.html')
+
+
+def test_fragment_store_rejects_parent_paths(store):
+    with pytest.raises(TemplateNotFound):
+        store.fragment('../profiles/other.yaml')
+
+
+def test_fragment_store_keeps_cached_fragment_when_s3_fails(store, bucket, clock, mocker):
+    store.fragment('header.html')
+    clock.now = 61
+    mocker.patch.object(StubObject, 'get', side_effect=ClientError({'Error': {'Code': '500'}}, 'GetObject'))
+
+    assert store.fragment('header.html').source == header.decode('utf-8')
+
+
+def test_fragment_store_skips_s3_while_circuit_is_open(bucket, clock, mocker):
+    breaker = CircuitBreaker('s3', failure_threshold=1, reset_seconds=100, clock=clock)
+    store = FragmentStore(bucket, 'fragments/', ttl_seconds=60, clock=clock, circuit_breaker=breaker)
+    store.fragment('header.html')
+    clock.now = 61
+    mocker.patch.object(StubObject, 'get', side_effect=ClientError(
+        {'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject'))
+    store.fragment('header.html')
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 122
+
+    assert store.fragment('header.html').source == header.decode('utf-8')
+    assert StubObject.get.call_count == 1
+    with pytest.raises(CircuitOpenError):
+        store.fragment('macros/table.html')
+
+
+def test_format_message_parts_includes_and_imports_fragments(store):
+    docsender = _docsender(store)
+    profile = docsender._parse_profile(_profile_data({
+        'body_html_template': '{% set title = event.name %}{% include "header.html" %}'
+                              '{% import "macros/table.html" as table %}{{ table.cell(event.name) }}',
+    }))
+
+    message_parts = docsender._format_message_parts(profile, {'name': '<bob>'})
+
+    assert message_parts['body']['html'] == '<h1>&lt;bob&gt;</h1><td>&lt;bob&gt;</td>'
+
+
+def test_fragments_are_compiled_once_per_process(store, mocker):
+    docsender = _docsender(store)
+    profile = docsender._parse_profile(_profile_data({
+        'body_html_template': '{% set title = event.name %}{% include "header.html" %}',
+    }))
+    compile_fragment = mocker.spy(store, 'compiled')
+    environment_compile = mocker.spy(_LimitedSandboxedEnvironment, 'compile')
+
+    for name in ['a', 'b', 'c']:
+        docsender._format_message_parts(profile, {'name': name})
+
+    assert compile_fragment.call_count == 3
+    fragment_compiles = [call for call in environment_compile.call_args_list if 'header.html' in call[0]]
+    assert len(fragment_compiles) == 1
+
+
+def test_trusted_profile_rejects_untrusted_fragment(store):
+    profile_data = _profile_data({'body_html_template': '{% include "header.html" %}'})
+    docsender = _docsender(store, trusted=[profile_data])
+    profile = docsender._parse_profile(profile_data)
+
+    with pytest.raises(SecurityError):
+        docsender._format_message_parts(profile, {})
+
+
+def test_trusted_profile_reloads_only_changed_fragment(store, bucket, clock, mocker):
+    profile_data = _profile_data({
+        'subject_template': 'subject',
+        'body_html_template': '{% set title = "t" %}{% include "header.html" %}',
+    })
+    changed_header = b'<h2>{{ title }}</h2>'
+    docsender = _docsender(store, trusted=[profile_data, header, changed_header])
+    profile = docsender._parse_profile(profile_data)
+
+    assert docsender._format_message_parts(profile, {})['body']['html'] == '<h1>t</h1>'
+    environment = docsender._trusted_environments[profile.digest]
+    body_template = environment.get_template('body.html')
+
+    bucket.objects['fragments/header.html'] = changed_header
+    clock.now = 61
+
+    assert docsender._format_message_parts(profile, {})['body']['html'] == '<h2>t</h2>'
+    assert docsender._trusted_environments[profile.digest] is environment
+    assert environment.get_template('body.html') is body_template
+
+
+def test_load_fragment_store(mocker):
+    bucket = mocker.MagicMock()
+    breaker = CircuitBreaker('s3')
+
+    assert load_fragment_store(bucket, {}) is None
+    store = load_fragment_store(bucket, {'FRAGMENTS_PREFIX': 'fragments/', 'FRAGMENTS_TTL_SECONDS': '5'},
+                                circuit_breaker=breaker)
+    assert store._prefix == 'fragments/'
+    assert store._ttl_seconds == 5
+    assert store._circuit_breaker is breaker
@@ -0,0 +1,135 @@
+from botocore.exceptions import ClientError
+from ocoen.docsenderidempotency import DynamoDBIdempotencyStore, FileIdempotencyStore, MemoryIdempotencyStore, \
+    NoIdempotencyStore, S3IdempotencyStore, delivery_key, load_idempotency_store
+
+import pytest
+import time
+
+sns_event = {'profile_key': 'profile', 'result_key': 'result', 'period': '2017-10'}
+
+
+def test_delivery_key_uses_sns_message_id():
+    assert delivery_key({'MessageId': 'abc'}, 'profile', 'result', sns_event) == 'sns/abc'
+
+
+def test_delivery_key_without_message_id_hashes_event():
+    key1 = delivery_key({}, 'profile', 'result', sns_event)
+    key2 = delivery_key({}, 'profile', 'result', dict(sns_event))
+    key3 = delivery_key({}, 'profile', 'result', dict(sns_event, period='2017-11'))
+
+    assert key1.startswith('event/profile/result/')
+    assert key1 == key2
+    assert key1 != key3
+
+
+def test_memory_store_remembers_deliveries():
+    store = MemoryIdempotencyStore()
+
+    assert not store.is_delivered('a')
+    store.mark_delivered('a')
+    assert store.is_delivered('a')
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = MemoryIdempotencyStore(max_size=2)
+    store.mark_delivered('a')
+    store.mark_delivered('b')
+    store.is_delivered('a')
+    store.mark_delivered('c')
+
+    assert store.is_delivered('a')
+    assert not store.is_delivered('b')
+    assert store.is_delivered('c')
+
+
+def test_file_store_remembers_deliveries_across_instances(tmpdir):
+    FileIdempotencyStore(str(tmpdir)).mark_delivered('sns/abc')
+
+    store = FileIdempotencyStore(str(tmpdir))
+    assert store.is_delivered('sns/abc')
+    assert not store.is_delivered('sns/def')
+
+
+def test_s3_store(mocker):
+    bucket = mocker.MagicMock()
+    bucket.Object.return_value.load.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+    store = S3IdempotencyStore(bucket, 'idempotency/')
+
+    assert not store.is_delivered('sns/abc')
+    store.mark_delivered('sns/abc')
+
+    key = bucket.put_object.call_args[1]['Key']
+    assert key.startswith('idempotency/docsender_delivered/')
+    bucket.Object.assert_called_once_with(key)
+    bucket.Object.return_value.load.side_effect = None
+    assert store.is_delivered('sns/abc')
+
+
+def test_s3_store_raises_other_errors(mocker):
+    bucket = mocker.MagicMock()
+    bucket.Object.return_value.load.side_effect = ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+
+    with pytest.raises(ClientError):
+        S3IdempotencyStore(bucket).is_delivered('sns/abc')
+
+
+def test_dynamodb_store(mocker):
+    table = mocker.MagicMock()
+    table.get_item.return_value = {}
+    store = DynamoDBIdempotencyStore(table, ttl_seconds=60)
+
+    assert not store.is_delivered('sns/abc')
+    store.mark_delivered('sns/abc')
+
+    item = table.put_item.call_args[1]['Item']
+    assert item['delivery_key'] == 'sns/abc'
+    assert item['expires_at'] > time.time()
+    table.get_item.return_value = {'Item': item}
+    assert store.is_delivered('sns/abc')
+    table.get_item.return_value = {'Item': dict(item, expires_at=time.time() - 1)}
+    assert not store.is_delivered('sns/abc')
+
+
+def test_load_idempotency_store_defaults_to_none():
+    store = load_idempotency_store({})
+
+    assert isinstance(store, NoIdempotencyStore)
+    store.mark_delivered('a')
+    assert not store.is_delivered('a')
+
+
+def test_load_idempotency_store_memory():
+    store = load_idempotency_store({'IDEMPOTENCY_STORE': 'memory:5'})
+
+    assert isinstance(store, MemoryIdempotencyStore)
+    assert store._max_size == 5
+
+
+def test_load_idempotency_store_file(tmpdir):
+    store = load_idempotency_store({'IDEMPOTENCY_STORE': 'file:' + str(tmpdir)})
+
+    assert isinstance(store, FileIdempotencyStore)
+
+
+def test_load_idempotency_store_s3(mocker):
+    session = mocker.patch('boto3.session.Session')
+
+    store = load_idempotency_store({'IDEMPOTENCY_STORE': 's3:us-east-1:bucket:prefix/'})
+
+    session.assert_called_once_with(region_name='us-east-1')
+    session.return_value.resource.return_value.Bucket.assert_called_once_with('bucket')
+    assert store._prefix == 'prefix/'
+
+
+def test_load_idempotency_store_dynamodb(mocker):
+    session = mocker.patch('boto3.session.Session')
+
+    store = load_idempotency_store({'IDEMPOTENCY_STORE': 'dynamodb:us-east-1:table:3600'})
+
+    session.return_value.resource.return_value.Table.assert_called_once_with('table')
+    assert store._ttl_seconds == 3600
+
+
+def test_load_idempotency_store_unknown():
+    with pytest.raises(ValueError):
+        load_idempotency_store({'IDEMPOTENCY_STORE': 'redis'})
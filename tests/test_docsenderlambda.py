@@ -1,7 +1,11 @@
 from jwcrypto.common import base64url_encode
+from ocoen.docsenderbreakers import CircuitBreaker
+from ocoen.docsenderidempotency import MemoryIdempotencyStore
 from ocoen.docsenderlambda import TokenKeyProvider
+from ocoen.docsendertracing import InMemorySpanExporter, Tracer
 from unittest.mock import create_autospec
 
+import io
 import json
 import ocoen.docsender
 import ocoen.docsenderlambda
@@ -50,6 +54,101 @@ def test_handle_event(mocker):
     ocoen.docsenderlambda._docsender.send_email.assert_called_once_with(profile_key, result_key, sns_event)
 
 
+def test_handle_event_skips_already_delivered_messages(mocker):
+    mocker.patch('ocoen.docsenderlambda._docsender')
+    mocker.patch('ocoen.docsenderlambda._idempotency_store', MemoryIdempotencyStore())
+    event = {
+        'Records': [
+            {
+                'Sns': {
+                    'MessageId': 'message id',
+                    'Message': json.dumps({'profile_key': 'profile', 'result_key': 'result'}),
+                },
+            },
+        ],
+    }
+
+    ocoen.docsenderlambda.handle_event(event, None)
+    ocoen.docsenderlambda.handle_event(event, None)
+
+    ocoen.docsenderlambda._docsender.send_email.assert_called_once()
+
+
+def test_handle_event_does_not_mark_failed_sends_delivered(mocker):
+    docsender = mocker.patch('ocoen.docsenderlambda._docsender')
+    docsender.send_email.side_effect = [ValueError('failed'), None]
+    mocker.patch('ocoen.docsenderlambda._idempotency_store', MemoryIdempotencyStore())
+    event = {
+        'Records': [
+            {
+                'Sns': {
+                    'MessageId': 'message id',
+                    'Message': json.dumps({'profile_key': 'profile', 'result_key': 'result'}),
+                },
+            },
+        ],
+    }
+
+    with pytest.raises(ValueError):
+        ocoen.docsenderlambda.handle_event(event, None)
+    ocoen.docsenderlambda.handle_event(event, None)
+
+    assert docsender.send_email.call_count == 2
+
+
+def test_handle_event_succeeds_when_mark_delivered_fails(mocker):
+    docsender = mocker.patch('ocoen.docsenderlambda._docsender')
+    docsender.send_email.return_value = {'email_size': 10}
+    idempotency_store = mocker.patch('ocoen.docsenderlambda._idempotency_store')
+    idempotency_store.is_delivered.return_value = False
+    idempotency_store.mark_delivered.side_effect = IOError('store unavailable')
+    event = {
+        'Records': [
+            {
+                'Sns': {
+                    'MessageId': 'message id',
+                    'Message': json.dumps({'profile_key': 'profile', 'result_key': 'result'}),
+                },
+            },
+        ],
+    }
+
+    metrics = ocoen.docsenderlambda.handle_event(event, None)
+
+    assert metrics == {'email_size': 10}
+    idempotency_store.mark_delivered.assert_called_once()
+
+
+def test_handle_event_continues_sns_trace(mocker):
+    exporter = InMemorySpanExporter()
+    docsender = mocker.patch('ocoen.docsenderlambda._docsender')
+    docsender.tracer = Tracer([exporter])
+    event = {
+        'Records': [
+            {
+                'Sns': {
+                    'MessageId': 'message id',
+                    'Message': json.dumps({'profile_key': 'profile', 'result_key': 'result'}),
+                    'MessageAttributes': {
+                        'traceparent': {
+                            'Type': 'String',
+                            'Value': '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01',
+                        },
+                    },
+                },
+            },
+        ],
+    }
+
+    ocoen.docsenderlambda.handle_event(event, None)
+
+    span = exporter.spans[0]
+    assert span.name == 'handle_event'
+    assert span.trace_id == '4bf92f3577b34da6a3ce929d0e0e4736'
+    assert span.parent_id == '00f067aa0ba902b7'
+    assert span.attributes['sns_message_id'] == 'message id'
+
+
 def test_token_key_provider_generates_key(token_key_provider):
     key = token_key_provider.get_key()
 
@@ -188,3 +287,87 @@ def test_load_docsender_buckets_without_prefixes(mocker):
     assert token_key_manager._keys_bucket == used_regions['us-west-2'].resource.return_value.Bucket.return_value
     assert token_key_manager._keys_bucket_prefix == ''
     assert token_key_manager._keys_bucket_storage_class == 'TEST_CLASS'
+
+
+def test_load_render_limits_defaults(mocker):
+    mocker.patch.dict(os.environ, {})
+    for name in ['RENDER_MAX_SECONDS', 'RENDER_MAX_OUTPUT_SIZE', 'RENDER_MAX_LOOP_ITERATIONS']:
+        os.environ.pop(name, None)
+
+    assert ocoen.docsenderlambda.load_render_limits() == ocoen.docsender.DEFAULT_RENDER_LIMITS
+
+
+def test_load_render_limits_from_environment(mocker):
+    mocker.patch.dict(os.environ, {
+        'RENDER_MAX_SECONDS': '1.5',
+        'RENDER_MAX_OUTPUT_SIZE': '1000',
+        'RENDER_MAX_LOOP_ITERATIONS': '50',
+    })
+
+    render_limits = ocoen.docsenderlambda.load_render_limits()
+
+    assert render_limits == ocoen.docsender.RenderLimits(max_seconds=1.5, max_output_size=1000,
+                                                         max_loop_iterations=50)
+
+
+def test_load_trusted_profile_hashes(mocker):
+    mocker.patch.dict(os.environ, {'TRUSTED_PROFILE_HASHES': 'abc, def,'})
+
+    assert ocoen.docsenderlambda.load_trusted_profile_hashes() == ['abc', 'def']
+
+
+def test_load_warm_up_profile_keys_disabled_by_default(mocker):
+    mocker.patch.dict(os.environ, {}, clear=True)
+
+    assert ocoen.docsenderlambda.load_warm_up_profile_keys(mocker.MagicMock()) is None
+
+
+def test_load_warm_up_profile_keys_from_environment_and_manifest(mocker):
+    mocker.patch.dict(os.environ, {
+        'WARMUP_PROFILES': 'a.yaml, b.yaml',
+        'WARMUP_MANIFEST': 'warmup.yaml',
+    })
+    profiles_bucket = mocker.MagicMock()
+    profiles_bucket.Object.return_value.get.return_value = {'Body': io.BytesIO(b'- b.yaml\n- c.yaml\n')}
+
+    profile_keys = ocoen.docsenderlambda.load_warm_up_profile_keys(profiles_bucket)
+
+    profiles_bucket.Object.assert_called_once_with('warmup.yaml')
+    assert profile_keys == ['a.yaml', 'b.yaml', 'c.yaml']
+
+
+def test_load_warm_up_profile_keys_ignores_missing_manifest(mocker):
+    mocker.patch.dict(os.environ, {'WARMUP_MANIFEST': 'warmup.yaml'})
+    profiles_bucket = mocker.MagicMock()
+    profiles_bucket.Object.return_value.get.side_effect = ValueError('missing')
+
+    assert ocoen.docsenderlambda.load_warm_up_profile_keys(profiles_bucket) == []
+
+
+def test_load_warm_up_profile_keys_guards_manifest_with_circuit_breaker(mocker):
+    mocker.patch.dict(os.environ, {'WARMUP_PROFILES': 'a.yaml', 'WARMUP_MANIFEST': 'warmup.yaml'})
+    profiles_bucket = mocker.MagicMock()
+    breaker = CircuitBreaker('s3', failure_threshold=1)
+    with pytest.raises(ConnectionError):
+        with breaker.guard():
+            raise ConnectionError('timed out')
+
+    assert ocoen.docsenderlambda.load_warm_up_profile_keys(profiles_bucket, breaker) == ['a.yaml']
+    profiles_bucket.Object.assert_not_called()
+
+
+def test_load_docsender_warms_up(mocker):
+    mocker.patch.dict(os.environ, {
+        'SES_REGION': 'us-east-1',
+        'PROFILES_BUCKET': 'us-east-2:profile_bucket',
+        'RESULTS_BUCKET': 'us-west-1:result_bucket',
+        'KEYS_BUCKET': 'us-west-2:key_bucket:STANDARD',
+        'TOKEN_KMS_KEY': 'ap-southeast-1:my_key',
+        'WARMUP_PROFILES': 'a.yaml',
+    })
+    mocker.patch('boto3.session.Session')
+    warm_up = mocker.patch('ocoen.docsender.DocSender.warm_up', autospec=True)
+
+    docsender = ocoen.docsenderlambda.load_docsender()
+
+    warm_up.assert_called_once_with(docsender, ['a.yaml'])
@@ -0,0 +1,69 @@
+from ocoen.docsenderprofiling import SampledProfiler, _NOT_SAMPLED
+
+import logging
+import tracemalloc
+
+
+def _busy_function():
+    return [str(i) * 10 for i in range(10000)]
+
+
+def test_profile_disabled_returns_shared_null_context():
+    profiler = SampledProfiler(0)
+
+    assert profiler.profile('profile.yaml') is _NOT_SAMPLED
+
+
+def test_profile_not_sampled_above_rate():
+    profiler = SampledProfiler(0.25, random_source=lambda: 0.5)
+
+    assert profiler.profile('profile.yaml') is _NOT_SAMPLED
+
+
+def test_profile_logs_hot_functions_and_allocations(caplog):
+    profiler = SampledProfiler(1, top_n=5)
+
+    with caplog.at_level(logging.INFO, logger='ocoen.docsenderprofiling'):
+        with profiler.profile('profiles/month-end.yaml'):
+            data = _busy_function()
+
+    assert len(data) == 10000
+    summary = caplog.records[-1].getMessage()
+    assert summary.startswith('profile profiles/month-end.yaml: ')
+    assert '_busy_function' in summary
+    assert 'test_docsenderprofiling.py' in summary.split('top allocations')[1]
+    assert len(summary.split('top functions')[1].split('top allocations')[0].strip().splitlines()) == 6
+    assert not tracemalloc.is_tracing()
+
+
+def test_profile_only_one_invocation_at_a_time():
+    profiler = SampledProfiler(1)
+
+    with profiler.profile('first'):
+        assert profiler.profile('second') is _NOT_SAMPLED
+    with profiler.profile('third') as profiling:
+        assert profiling is None
+
+
+def test_profile_keeps_existing_tracemalloc_session():
+    profiler = SampledProfiler(1)
+    tracemalloc.start()
+    try:
+        with profiler.profile('profile.yaml'):
+            _busy_function()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_from_environ():
+    profiler = SampledProfiler.from_environ({'PROFILE_SAMPLE_RATE': '0.01', 'PROFILE_TOP_N': '5'})
+
+    assert profiler._sample_rate == 0.01
+    assert profiler._top_n == 5
+
+
+def test_from_environ_defaults_to_disabled():
+    profiler = SampledProfiler.from_environ({})
+
+    assert profiler.profile('profile.yaml') is _NOT_SAMPLED
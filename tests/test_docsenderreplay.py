@@ -0,0 +1,194 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from email import message_from_bytes
+from ocoen.docsenderreplay import Latency, LocalBucket, Replayer, ReplayStats, main, percentile, read_jsonl_events
+
+import json
+import ocoen.docsenderlambda
+import os
+import pytest
+import threading
+import time
+import yaml
+
+
+sns_event = {
+    'profile_key': 'profile.yaml',
+    'result_key': 'result.csv',
+}
+
+
+@pytest.fixture
+def buckets(tmpdir):
+    profiles = tmpdir.mkdir('profiles')
+    profiles.join('profile.yaml').write(yaml.dump({'email': {
+        'from': 'from@example.com',
+        'to': 'to@example.com',
+        'subject_template': 'Report {{ event.period }}',
+        'body_text_template': 'Attached.',
+        'attachment_name_template': 'report.csv',
+    }}))
+    results = tmpdir.mkdir('results')
+    results.join('result.csv').write('a,b\n1,2\n')
+    return str(profiles), str(results)
+
+
+@pytest.fixture
+def restore_lambda_globals():
+    docsender = ocoen.docsenderlambda._docsender
+    idempotency_store = ocoen.docsenderlambda._idempotency_store
+    yield
+    ocoen.docsenderlambda._docsender = docsender
+    ocoen.docsenderlambda._idempotency_store = idempotency_store
+
+
+def test_read_jsonl_events_wraps_each_sns_record_as_a_lambda_event():
+    message = json.dumps(sns_event)
+    lines = [
+        json.dumps({'Records': [{'Sns': {'Message': message}}, {'Sns': {'Message': message}}]}),
+        json.dumps({'Sns': {'Message': message, 'MessageId': 'id'}}),
+        '',
+        json.dumps({'Message': message}),
+        json.dumps(sns_event),
+    ]
+
+    events = list(read_jsonl_events(lines))
+
+    assert len(events) == 5
+    assert all(len(event['Records']) == 1 for event in events)
+    assert all(json.loads(event['Records'][0]['Sns']['Message']) == sns_event for event in events)
+    assert events[2]['Records'][0]['Sns']['MessageId'] == 'id'
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile(values, 1) == 100
+    assert percentile([7], 0.5) == 7
+    assert percentile([], 0.5) is None
+
+
+def test_latency_waits_with_jitter(mocker):
+    sleep = mocker.patch('time.sleep')
+
+    Latency(0.1, 0.5, random_source=lambda low, high: high).wait()
+    Latency().wait()
+
+    sleep.assert_called_once_with(pytest.approx(0.15))
+
+
+def test_local_bucket_reads_directory_and_put_objects(buckets):
+    bucket = LocalBucket(buckets[1])
+    bucket.put_object(Key='keys/key', Body=b'key')
+
+    response = bucket.Object('result.csv').get()
+    assert response['Body'].read() == b'a,b\n1,2\n'
+    assert response['ContentType'] == 'text/csv'
+    assert response['ContentLength'] == 8
+    assert bucket.Object('keys/key').get()['Body'].read() == b'key'
+    with pytest.raises(ClientError):
+        bucket.Object('missing.csv').get()
+    with pytest.raises(ClientError) as e:
+        bucket.Object('result.csv').get(IfNoneMatch=response['ETag'])
+    assert e.value.response['Error']['Code'] == '304'
+
+
+def test_replayer_records_sent_skipped_and_failed_events():
+    def handle_event(event, context):
+        if event == 'fail':
+            raise ValueError('failed')
+        if event == 'skip':
+            return None
+        return {'load_profile': 0.1, 'send_raw_email': 0.2, 'email_size': 100}
+
+    with ThreadPoolExecutor(2) as executor:
+        stats = Replayer(executor, 2, handle_event=handle_event).run(iter(['send', 'skip', 'fail', 'send']))
+
+    assert stats.received == 4
+    assert stats.sent == 2
+    assert stats.skipped == 1
+    assert stats.errors == {'ValueError': 1}
+    assert stats.bytes_sent == 200
+    assert stats.latencies['load_profile'] == [0.1, 0.1]
+    assert len(stats.latencies['handle_event']) == 4
+    formatted = stats.format()
+    assert 'Error rate: 25.00%' in formatted
+    assert 'send_raw_email' in formatted
+
+
+def test_replayer_bounds_concurrency():
+    in_flight = [0]
+    max_in_flight = [0]
+    lock = threading.Lock()
+
+    def handle_event(event, context):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return {}
+
+    with ThreadPoolExecutor(10) as executor:
+        Replayer(executor, 3, handle_event=handle_event).run(iter(range(20)))
+
+    assert max_in_flight[0] == 3
+
+
+def test_replayer_paces_arrivals_at_rate():
+    with ThreadPoolExecutor(4) as executor:
+        stats = Replayer(executor, 4, rate=100, handle_event=lambda event, context: {}).run(iter(range(10)))
+
+    assert stats.end_time - stats.start_time >= 0.09
+
+
+def test_replay_stats_format_without_events():
+    assert 'Replayed 0 events' in ReplayStats().format()
+
+
+def test_main_replays_through_handle_event(buckets, tmpdir, restore_lambda_globals, capsys):
+    events = tmpdir.join('events.jsonl')
+    events.write('\n'.join(
+        json.dumps({'Records': [{'Sns': {'MessageId': str(i), 'Message': json.dumps(dict(sns_event, period=i))}}]})
+        for i in range(3)
+    ) + '\n' + json.dumps(dict(sns_event, result_key='missing.csv')))
+    eml_dir = tmpdir.join('eml')
+
+    result = main([str(events), '--profiles-dir', buckets[0], '--results-dir', buckets[1],
+                   '--concurrency', '2', '--ses-latency', '0.001', '--eml-dir', str(eml_dir)])
+
+    assert result == 1
+    output = capsys.readouterr().out
+    assert 'Replayed 4 events' in output
+    assert '3 sent, 0 skipped, 1 failed' in output
+    assert 'ClientError 1' in output
+    emails = [message_from_bytes(eml.read_binary()) for eml in eml_dir.listdir()]
+    assert sorted(email['Subject'] for email in emails) == ['Report 0', 'Report 1', 'Report 2']
+    assert all(email['X-OCOEN-TRACKING-TOKEN'] for email in emails)
+
+
+def test_main_replays_profiles_with_fragments(buckets, tmpdir, restore_lambda_globals, capsys, mocker):
+    profiles = tmpdir.join('profiles')
+    profiles.join('fragment.yaml').write(yaml.dump({'email': {
+        'from': 'from@example.com',
+        'to': 'to@example.com',
+        'subject_template': 'Report {{ event.period }}',
+        'body_text_template': '{% include "header.txt" %}',
+        'attachment_name_template': 'report.csv',
+    }}))
+    profiles.mkdir('fragments').join('header.txt').write('Report for {{ event.period }}')
+    mocker.patch.dict(os.environ, {'FRAGMENTS_PREFIX': 'fragments/'})
+    events = tmpdir.join('events.jsonl')
+    events.write(json.dumps(dict(sns_event, profile_key='fragment.yaml', period=7)))
+    eml_dir = tmpdir.join('eml')
+
+    result = main([str(events), '--profiles-dir', buckets[0], '--results-dir', buckets[1],
+                   '--eml-dir', str(eml_dir)])
+
+    assert result == 0
+    assert '1 sent, 0 skipped, 0 failed' in capsys.readouterr().out
+    email, = [message_from_bytes(eml.read_binary()) for eml in eml_dir.listdir()]
+    assert email.get_payload()[0].get_payload().strip() == 'Report for 7'
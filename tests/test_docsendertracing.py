@@ -0,0 +1,121 @@
+from ocoen.docsendertracing import InMemorySpanExporter, LoggingSpanExporter, NOOP_TRACER, SpanContext, Tracer, \
+    load_tracer, parse_traceparent, parse_xray_trace_header, sns_trace_context
+
+import pytest
+
+trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+span_id = '00f067aa0ba902b7'
+
+
+@pytest.fixture
+def exporter():
+    return InMemorySpanExporter()
+
+
+@pytest.fixture
+def tracer(exporter):
+    return Tracer([exporter])
+
+
+def test_parse_traceparent():
+    context = parse_traceparent('00-{}-{}-01'.format(trace_id, span_id))
+
+    assert context == SpanContext(trace_id, span_id, True)
+
+
+@pytest.mark.parametrize('traceparent', [
+    'garbage',
+    'ff-{}-{}-01'.format(trace_id, span_id),
+    '00-{}-{}-01'.format('0' * 32, span_id),
+    '00-{}-{}-01'.format(trace_id, '0' * 16),
+])
+def test_parse_traceparent_invalid(traceparent):
+    assert parse_traceparent(traceparent) is None
+
+
+def test_parse_xray_trace_header():
+    context = parse_xray_trace_header('Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=0')
+
+    assert context == SpanContext('5759e988bd862e3fe1be46a994272793', '53995c3f42cd8ad8', False)
+
+
+def test_sns_trace_context_prefers_traceparent():
+    context = sns_trace_context({
+        'MessageAttributes': {
+            'traceparent': {'Type': 'String', 'Value': '00-{}-{}-01'.format(trace_id, span_id)},
+            'AWSTraceHeader': {
+                'Type': 'String',
+                'Value': 'Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8',
+            },
+        },
+    })
+
+    assert context.trace_id == trace_id
+
+
+def test_sns_trace_context_without_attributes():
+    assert sns_trace_context({'Message': '{}'}) is None
+
+
+def test_tracer_nests_spans_in_same_trace(tracer, exporter):
+    with tracer.span('parent', parent=SpanContext(trace_id, span_id, True)) as parent:
+        with tracer.span('child', attributes={'size': 10}) as child:
+            pass
+
+    assert [span.name for span in exporter.spans] == ['child', 'parent']
+    assert parent.trace_id == trace_id
+    assert parent.parent_id == span_id
+    assert child.trace_id == trace_id
+    assert child.parent_id == parent.span_id
+    assert child.attributes == {'size': 10}
+    assert child.duration >= 0
+    assert tracer.current_span() is None
+
+
+def test_tracer_span_without_activation_is_not_current(tracer):
+    with tracer.span('parent', activate=False) as parent:
+        assert tracer.current_span() is None
+        with tracer.activate(parent):
+            assert tracer.current_span() is parent
+
+
+def test_tracer_records_errors(tracer, exporter):
+    with pytest.raises(KeyError):
+        with tracer.span('failing'):
+            raise KeyError('missing')
+
+    assert exporter.spans[0].status == 'error'
+    assert exporter.spans[0].attributes['error'] == 'KeyError'
+
+
+def test_tracer_ignores_exporter_failures(mocker):
+    failing_exporter = mocker.MagicMock()
+    failing_exporter.export.side_effect = ValueError('unavailable')
+    exporter = InMemorySpanExporter()
+    tracer = Tracer([failing_exporter, exporter])
+
+    with tracer.span('span'):
+        pass
+
+    assert len(exporter.spans) == 1
+
+
+def test_noop_tracer():
+    with NOOP_TRACER.span('span', attributes={'a': 1}) as span:
+        span.set_attribute('b', 2)
+
+
+def test_load_tracer_defaults_to_noop():
+    assert load_tracer({}) is NOOP_TRACER
+
+
+def test_load_tracer_with_exporters():
+    tracer = load_tracer({'TRACING_EXPORTERS': 'log, ocoen.docsendertracing:InMemorySpanExporter'})
+
+    assert isinstance(tracer._exporters[0], LoggingSpanExporter)
+    assert isinstance(tracer._exporters[1], InMemorySpanExporter)
+
+
+def test_load_tracer_unknown_exporter():
+    with pytest.raises(ValueError):
+        load_tracer({'TRACING_EXPORTERS': 'unknown'})
@@ -0,0 +1,186 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ocoen.docsenderadmission import AdaptiveConcurrencyLimit, MemoryBudget, estimate_send_bytes
+from ocoen.docsenderbreakers import CircuitOpenError
+from ocoen.docsenderworker import BuildError, Worker, read_jsonl_messages, read_sqs_messages
+
+import json
+import ocoen.docsenderworker
+import os
+import pytest
+import threading
+
+
+sns_event = {
+    'profile_key': 'profile',
+    'result_key': 'result',
+}
+
+
+class ThrottledDocSender:
+
+    def build_email(self, profile_key, attachment_key, event):
+        raise ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+
+
+@pytest.fixture
+def docsender(mocker):
+    docsender = mocker.patch('ocoen.docsenderworker._docsender')
+    docsender.build_email.side_effect = lambda profile_key, attachment_key, event: (
+        b'email for ' + attachment_key.encode('utf-8'),
+        {'load_profile': 1.0, 'email_size': 10},
+    )
+    return docsender
+
+
+@pytest.fixture
+def executors():
+    with ThreadPoolExecutor(2) as build_executor, ThreadPoolExecutor(2) as send_executor:
+        yield build_executor, send_executor
+
+
+def test_read_jsonl_messages_accepts_lambda_sns_and_plain_events():
+    message = json.dumps(sns_event)
+    lines = [
+        json.dumps({'Records': [{'Sns': {'Message': message}}, {'Sns': {'Message': message}}]}),
+        json.dumps({'Sns': {'Message': message}}),
+        '',
+        json.dumps({'Message': message}),
+        json.dumps(sns_event),
+    ]
+
+    messages = list(read_jsonl_messages(lines))
+
+    assert len(messages) == 5
+    assert all(json.loads(message) == sns_event and ack is None for message, ack in messages)
+
+
+def test_read_sqs_messages_acks_with_receipt_handle(mocker):
+    sqs = mocker.MagicMock()
+    stop_event = threading.Event()
+
+    def receive_message(**kwargs):
+        stop_event.set()
+        return {'Messages': [{'ReceiptHandle': 'receipt', 'Body': json.dumps({'Message': json.dumps(sns_event)})}]}
+    sqs.receive_message.side_effect = receive_message
+
+    messages = list(read_sqs_messages(sqs, 'queue', stop_event))
+
+    assert len(messages) == 1
+    message, ack = messages[0]
+    assert json.loads(message) == sns_event
+    ack()
+    sqs.delete_message.assert_called_once_with(QueueUrl='queue', ReceiptHandle='receipt')
+
+
+def test_worker_builds_and_sends_all_messages(docsender, executors, mocker):
+    send_raw_email = mocker.MagicMock()
+    ack = mocker.MagicMock()
+    messages = [(json.dumps(dict(sns_event, result_key='result{}'.format(i))), ack) for i in range(5)]
+    worker = Worker(executors[0], executors[1], send_raw_email, 2)
+
+    stats = worker.run(iter(messages))
+
+    assert stats.received == 5
+    assert stats.sent == 5
+    assert stats.failed == 0
+    assert stats.bytes_sent == 50
+    assert ack.call_count == 5
+    sent = sorted(call[0][0] for call in send_raw_email.call_args_list)
+    assert sent == [b'email for result' + str(i).encode('utf-8') for i in range(5)]
+    assert 'Mean stage timings: load_profile 1.000s' in stats.format()
+
+
+def test_worker_counts_failures_without_acking(docsender, executors, mocker):
+    docsender.build_email.side_effect = ValueError('bad profile')
+    send_raw_email = mocker.MagicMock()
+    ack = mocker.MagicMock()
+    worker = Worker(executors[0], executors[1], send_raw_email, 2)
+
+    stats = worker.run(iter([(json.dumps(sns_event), ack)]))
+
+    assert stats.failed == 1
+    assert stats.sent == 0
+    send_raw_email.assert_not_called()
+    ack.assert_not_called()
+
+
+def test_worker_backs_off_when_builds_are_rejected(docsender, executors, mocker):
+    docsender.build_email.side_effect = [CircuitOpenError('s3', 10), ValueError('bad profile')]
+    limit = AdaptiveConcurrencyLimit(initial_limit=8)
+    worker = Worker(executors[0], executors[1], mocker.MagicMock(), 2, limit)
+
+    stats = worker.run(iter([(json.dumps(sns_event), None), (json.dumps(sns_event), None)]))
+
+    assert stats.failed == 2
+    assert limit.limit == 4
+    assert limit.in_flight == 0
+
+
+def test_worker_admits_sends_against_memory_budget(docsender, executors, mocker):
+    docsender.build_email.side_effect = lambda profile_key, attachment_key, event: (
+        b'email', {'attachment_size': 100, 'email_size': 10})
+    budget = MemoryBudget(estimate_send_bytes(100))
+    in_flight_while_sending = []
+    worker = Worker(executors[0], executors[1], lambda email, metrics: in_flight_while_sending.append(
+        budget.in_flight_bytes), 4, memory_budget=budget)
+
+    stats = worker.run(iter([(json.dumps(sns_event), None)] * 4))
+
+    assert stats.sent == 4
+    assert in_flight_while_sending == [estimate_send_bytes(100)] * 4
+    assert budget.in_flight_bytes == 0
+
+
+def test_worker_stops_reading_after_stop(docsender, executors, mocker):
+    worker = Worker(executors[0], executors[1], mocker.MagicMock(), 2)
+
+    def messages():
+        yield json.dumps(sns_event), None
+        worker.stop()
+        yield json.dumps(sns_event), None
+        yield json.dumps(sns_event), None
+
+    stats = worker.run(messages())
+
+    assert stats.received == 1
+    assert stats.sent == 1
+
+
+def test_worker_process_ignores_termination_signals(mocker):
+    mocker.patch('ocoen.docsenderworker._docsender', None)
+    mock_signal = mocker.patch('signal.signal')
+    load_docsender = mocker.patch('ocoen.docsenderworker.load_docsender')
+
+    ocoen.docsenderworker._build_email(json.dumps(sns_event))
+
+    assert mock_signal.call_count == 2
+    load_docsender.return_value.build_email.assert_called_once_with('profile', 'result', sns_event)
+
+
+def test_worker_process_leaves_memory_budget_to_parent(mocker):
+    mocker.patch('ocoen.docsenderworker._docsender', None)
+    mocker.patch('signal.signal')
+    mocker.patch.dict(os.environ, {'MEMORY_BUDGET_FRACTION': '0.5'})
+    fractions = []
+    load_docsender = mocker.patch('ocoen.docsenderworker.load_docsender')
+    load_docsender.side_effect = lambda: fractions.append(os.environ.get('MEMORY_BUDGET_FRACTION')) or mocker.DEFAULT
+
+    ocoen.docsenderworker._build_email(json.dumps(sns_event))
+
+    assert fractions == [None]
+
+
+def test_worker_process_errors_reach_the_parent(mocker):
+    # Forked build processes inherit the patched docsender.
+    mocker.patch('ocoen.docsenderworker._docsender', ThrottledDocSender())
+
+    with ProcessPoolExecutor(1) as build_executor:
+        with pytest.raises(BuildError) as e:
+            build_executor.submit(ocoen.docsenderworker._build_email, json.dumps(sns_event)).result(timeout=30)
+
+    assert e.value.code == 'SlowDown'
+    assert e.value.status == 503
+    assert e.value.service_failure
+    assert not e.value.circuit_open
+    assert 'SlowDown' in str(e.value)